@@ -0,0 +1,70 @@
+import sys
+import time
+import getopt
+import random
+import threading
+from datetime import datetime, timedelta
+from crontab import Crontab
+
+Specs = [
+    "* * * * *",
+    "*/5 9-12,14-17 * * 1-5",
+    "0-5,18-20,22,52-59 | 9-12,14-18 | * | * | 1-6",
+    "0 0 29 2 *",
+]
+Minutes = 3
+
+
+def bench_next_time(count=10000):
+    print('spec\tnext_time() calls/s')
+    start = datetime(2024, 1, 1)
+    for spec in Specs:
+        cron = Crontab(spec, None)
+        times = [start + timedelta(minutes=random.randrange(60 * 24 * 365)) for i in range(count)]
+        t0 = time.perf_counter()
+        for tm in times:
+            cron.next_time(tm)
+        elapsed = time.perf_counter() - t0
+        print(f'{spec}\t{count / elapsed:.0f}')
+
+
+def bench_firing(minutes):
+    # fire every minute and record how late each run starts
+    jitter = []
+
+    def job():
+        jitter.append((datetime.now() - cron.last_slot).total_seconds())
+        if len(jitter) >= minutes:
+            cron.stop()
+
+    cron = Crontab("* * * * *", job)
+    thread = threading.Thread(target=cron.run)
+    cpu = time.process_time()
+    wall = time.time()
+    thread.start()
+    thread.join()
+    cpu = time.process_time() - cpu
+    wall = time.time() - wall
+
+    jitter_ms = sorted(x * 1000 for x in jitter)
+    print(f'fired {len(jitter)} times in {wall:.0f}s')
+    print(f'jitter ms: min {jitter_ms[0]:.2f}  median {jitter_ms[len(jitter_ms) // 2]:.2f}  '
+          f'max {jitter_ms[-1]:.2f}')
+    print(f'idle CPU: {cpu:.4f}s ({cpu / wall * 100:.4f}% of wall time)')
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    minutes = Minutes
+    try:
+        opts, args = getopt.getopt(argv, 'm:')
+        Options = dict(opts)
+        if '-m' in Options.keys():
+            minutes = int(Options['-m'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    bench_next_time()
+    if minutes > 0:
+        bench_firing(minutes)
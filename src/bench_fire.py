@@ -0,0 +1,164 @@
+import os
+import sys
+import time
+import getopt
+import random
+import tempfile
+import datetime
+import pandas as pd
+import fireworks
+from fireworks import Firework, pack_day, raw_db, daily_db, shard_db, packed_db
+from fireemu import FireEmulator
+
+Tickers = 60
+Ticks = 480             # one tick a minute, 9-12 and 14-17 as iopvfire runs
+Changed = 0.2           # share of tickers whose price moves on a tick
+ChartEvery = 30         # ticks between chart builds
+DailyDays = 200         # daily bars already in the database
+RawDays = 2             # earlier days of ticks already in the database
+Day = datetime.date(2024, 1, 10)
+
+
+def tick_times(day, ticks):
+    hours = [9, 10, 11, 12, 14, 15, 16, 17]
+    times = [datetime.datetime.combine(day, datetime.time(h, m)) for h in hours for m in range(60)]
+    return times[:ticks]
+
+
+def walk(prices, changed):
+    moved = {}
+    for ticker, iopv in prices.items():
+        if random.random() < changed:
+            moved[ticker] = prices[ticker] = round(iopv + random.choice([-0.001, 0.001]), 4)
+    return moved
+
+
+def seed(tickers, ticks, changed, daily_days, raw_days):
+    # the database as it stands before the day: stock list, daily bars
+    # and a few days of ticks in the layouts being written
+    random.seed(1)
+    stocks = dict((f'ETF-{i}', {'STOCK': f'Stock {i}', 'TICKER': f'ETF-{i}'}) for i in range(tickers))
+    prices = dict((x, round(random.uniform(0.5, 5), 4)) for x in stocks)
+    data = {'stock-list': stocks, daily_db: {}, raw_db: {},
+            shard_db: {}, packed_db: {}}
+
+    for n in range(daily_days, 0, -1):
+        date = str(Day - datetime.timedelta(n))
+        bars = {}
+        for ticker, iopv in prices.items():
+            bars[ticker] = {'OPEN': iopv, 'HIGH': iopv + 0.01, 'LOW': iopv - 0.01, 'CLOSE': iopv}
+        data[daily_db][date] = {'DATE': date, 'IOPV': bars}
+
+    for n in range(raw_days, 0, -1):
+        day = Day - datetime.timedelta(n)
+        series = dict((x, []) for x in prices)
+        for i, now in enumerate(tick_times(day, ticks)):
+            moved = dict(prices) if i == 0 else walk(prices, changed)
+            timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+            # a tick with nothing moved writes no snapshot, as in iopvfire
+            if 'market' in fireworks.raw_layouts and moved:
+                data[raw_db][timestamp] = {'DATE': timestamp, 'IOPV': moved}
+            for ticker, iopv in prices.items():
+                sec = (now - datetime.datetime.combine(day, datetime.time())).seconds
+                series[ticker].append((sec, iopv))
+                if 'ticker' in fireworks.raw_layouts and ticker in moved:
+                    data[shard_db].setdefault(ticker, {}).setdefault(str(day), {})[timestamp[11:]] = iopv
+        if 'packed' in fireworks.raw_layouts:
+            for ticker, day_ticks in series.items():
+                data[packed_db].setdefault(ticker, {})[str(day)] = pack_day(day_ticks)
+    return data, prices
+
+
+class Meter:
+    # latency and bytes of each call, from the emulator's request log
+    def __init__(self, emulator):
+        self.emulator = emulator
+        self.calls = {}
+
+    def __call__(self, name, func, *args, **kwargs):
+        requests, sent, received = self.emulator.counters()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        after = self.emulator.counters()
+        self.calls.setdefault(name, []).append(
+            (elapsed, after[0] - requests, after[1] - sent, after[2] - received))
+        return result
+
+    def report(self):
+        print(f'{"call":<18}calls\treq/call\tmean ms\tp50 ms\tp95 ms\tmax ms\tKB up\tKB down')
+        for name, calls in self.calls.items():
+            times = sorted(x[0] * 1000 for x in calls)
+            n = len(calls)
+            print(f'{name:<18}{n}\t{sum(x[1] for x in calls) / n:.1f}\t\t'
+                  f'{sum(times) / n:.1f}\t{times[n // 2]:.1f}\t{times[int(n * 0.95)]:.1f}\t'
+                  f'{times[-1]:.1f}\t{sum(x[2] for x in calls) / n / 1024:.1f}\t'
+                  f'{sum(x[3] for x in calls) / n / 1024:.1f}')
+        requests, sent, received = self.emulator.counters()
+        print(f'total: {requests} requests, {sent / 2 ** 20:.2f} MB up, '
+              f'{received / 2 ** 20:.2f} MB down')
+
+
+def charts(fire, tickers):
+    # the reads of stockcharts.make_firebase_charts()
+    daily = fire.get_stock_daily(tickers, last=200, result='frame')
+    raw = fire.get_ticker_raw(tickers, result='frame')
+    missing = [x for x in tickers if x not in set(raw.TICKER)]
+    if missing:
+        extra = fire.get_stock_raw(missing, last=1200, result='frame')
+        raw = pd.concat([raw, extra], ignore_index=True)
+    return daily, raw
+
+
+def main(tickers, ticks, changed, chart_every, mirror):
+    data, prices = seed(tickers, ticks, changed, DailyDays, RawDays)
+    print(f'{tickers} tickers x {ticks} ticks, layouts {",".join(fireworks.raw_layouts)}'
+          f'{", charts from a mirror" if mirror else ""}')
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp, FireEmulator(data) as emulator:
+        os.chdir(tmp)
+        try:
+            fireworks.ohlc_state_file = os.path.join(tmp, 'iopv-ohlc.json')
+            fireworks.stock_cache_file = os.path.join(tmp, 'stock-list-cache.json')
+            config_file = os.path.join(tmp, 'emulator_config.json')
+            emulator.write_config(config_file)
+            fire = Firework(config_file, mirror_file='mirror.sqlite' if mirror else None)
+            meter = Meter(emulator)
+            names = dict((x, f'Stock {x[4:]}') for x in prices)
+            for i, now in enumerate(tick_times(Day, ticks)):
+                moved = dict(prices) if i == 0 else walk(prices, changed)
+                iopv_list = [(names[x], iopv) for x, iopv in moved.items()]
+                if iopv_list:
+                    meter('update_iopv_list', fire.update_iopv_list, iopv_list, logtime=now)
+                meter('heartbeat', fire.heartbeat, len(moved), logtime=now)
+                if (i + 1) % chart_every == 0:
+                    meter('charts', charts, fire, list(prices))
+        finally:
+            os.chdir(cwd)
+        meter.report()
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    tickers, ticks, changed, chart_every, mirror = Tickers, Ticks, Changed, ChartEvery, False
+    try:
+        opts, args = getopt.getopt(argv, 'c:l:mn:p:t:')
+        Options = dict(opts)
+        if '-c' in Options.keys():
+            chart_every = int(Options['-c'])
+        if '-l' in Options.keys():
+            fireworks.raw_layouts = tuple(Options['-l'].split(','))
+        if '-m' in Options.keys():
+            mirror = True
+        if '-n' in Options.keys():
+            tickers = int(Options['-n'])
+        if '-p' in Options.keys():
+            changed = float(Options['-p'])
+        if '-t' in Options.keys():
+            ticks = int(Options['-t'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    main(tickers, ticks, changed, chart_every, mirror)
@@ -0,0 +1,102 @@
+import sys
+import time
+import getopt
+import random
+import numpy as np
+import pandas as pd
+from fireworks import daily_ohlc
+
+Tickers = 100
+Days = 250          # about one year of trading days
+Ticks = 60          # IOPV ticks per ticker per day
+Legacy = 5          # tickers timed with the old per-ticker path
+
+
+def trim_leading_iopv(df):
+    # the per-ticker path daily_ohlc() replaces
+    for i in range(len(df) - 1):
+        iopv1 = df.iloc[i]['IOPV']
+        iopv2 = df.iloc[i + 1]['IOPV']
+        if iopv1 != iopv2:
+            return df[i + 1:]
+    else:
+        return df
+
+
+def get_ohlc(ilist):
+    df = pd.DataFrame(ilist)
+    dfs = df.sort_values(by='DATE', ascending=True)
+    dft = trim_leading_iopv(dfs)
+    op = dft.iloc[0]['IOPV']
+    cl = dft.iloc[-1]['IOPV']
+    hi = dft['IOPV'].max()
+    lo = dft['IOPV'].min()
+    return op, hi, lo, cl
+
+
+def make_history(tickers, days, ticks):
+    # random walk per ticker; each day opens with a run of the previous
+    # close, like the carry-over seen before the market publishes
+    rng = np.random.default_rng(1)
+    dates = pd.bdate_range('2024-01-02', periods=days)
+    offsets = pd.to_timedelta(9 * 3600 + np.arange(ticks) * 60, unit='s')
+    stamps = (dates.values[:, None] + offsets.values[None, :]).ravel()
+    stamps = pd.DatetimeIndex(stamps).strftime("%Y-%m-%d %H:%M:%S")
+
+    frames = []
+    for i in range(tickers):
+        steps = rng.choice([-0.01, 0, 0, 0.01], size=days * ticks)
+        iopv = np.round(1 + np.cumsum(steps) / 10, 4).reshape(days, ticks)
+        lead = rng.integers(0, ticks // 4, size=days)
+        for d in range(1, days):
+            iopv[d, :lead[d]] = iopv[d - 1, -1]
+        frames.append(pd.DataFrame({'DATE': stamps, 'TICKER': f'ETF-{i}',
+                                    'IOPV': iopv.ravel()}))
+
+    df = pd.concat(frames, ignore_index=True)
+    return df.sample(frac=1, random_state=1).reset_index(drop=True)
+
+
+def main(tickers, days, ticks, legacy):
+    df = make_history(tickers, days, ticks)
+    print(f'{tickers} tickers x {days} days x {ticks} ticks = {len(df)} rows')
+
+    start = time.perf_counter()
+    bars = daily_ohlc(df)
+    elapsed = time.perf_counter() - start
+    print(f'daily_ohlc:\t{elapsed:.3f}s\t{len(bars) / elapsed:.0f} bars/s')
+
+    # the old path, one ticker-day at a time, on a few tickers only
+    subset = df[df['TICKER'].isin([f'ETF-{i}' for i in range(legacy)])]
+    groups = subset.groupby(['TICKER', subset['DATE'].str[:10]])
+    start = time.perf_counter()
+    expected = dict((key, get_ohlc(g[['DATE', 'IOPV']].to_dict('records'))) for key, g in groups)
+    elapsed = time.perf_counter() - start
+    print(f'get_ohlc:\t{elapsed:.3f}s\t{len(expected) / elapsed:.0f} bars/s')
+
+    for bar in bars.itertuples(index=False):
+        key = (bar.TICKER, str(bar.DAY.date()))
+        if key in expected:
+            assert (bar.OPEN, bar.HIGH, bar.LOW, bar.CLOSE) == expected[key], key
+    print(f'{len(expected)} bars match')
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    tickers, days, ticks, legacy = Tickers, Days, Ticks, Legacy
+    try:
+        opts, args = getopt.getopt(argv, 'd:l:n:t:')
+        Options = dict(opts)
+        if '-d' in Options.keys():
+            days = int(Options['-d'])
+        if '-l' in Options.keys():
+            legacy = int(Options['-l'])
+        if '-n' in Options.keys():
+            tickers = int(Options['-n'])
+        if '-t' in Options.keys():
+            ticks = int(Options['-t'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    main(tickers, days, ticks, legacy)
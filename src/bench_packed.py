@@ -0,0 +1,117 @@
+import sys
+import json
+import time
+import getopt
+import random
+from fireworks import pack_day, unpack_day
+
+Tickers = 100
+Ticks = 480             # one tick a minute over a trading day
+Rounds = 20
+Day = '2024-01-02'
+
+
+def make_day(tickers, ticks):
+    # ticks[ticker] = [(seconds of the day, iopv), ...], prices move on
+    # about one tick in five, the rest repeat the last price
+    random.seed(1)
+    start = 9 * 3600
+    day = {}
+    for i in range(tickers):
+        iopv = round(random.uniform(0.5, 5), 4)
+        series = []
+        for n in range(ticks):
+            if random.random() < 0.2:
+                iopv = round(iopv + random.choice([-0.001, 0.001]), 4)
+            series.append((start + n * 60, iopv))
+        day[f'ETF-{i}'] = series
+    return day
+
+
+def stamp(sec):
+    return f'{Day} {sec // 3600:02d}:{sec // 60 % 60:02d}:{sec % 60:02d}'
+
+
+def encode_market(day):
+    # iopv-raw: one snapshot of every ticker per timestamp
+    snapshots = {}
+    for ticker, series in day.items():
+        for sec, iopv in series:
+            ts = stamp(sec)
+            snapshots.setdefault(ts, {'DATE': ts, 'IOPV': {}})['IOPV'][ticker] = iopv
+    return json.dumps(snapshots)
+
+
+def decode_market(payload, ticker):
+    rows = []
+    for row in json.loads(payload).values():
+        if ticker in row['IOPV']:
+            rows.append({'DATE': row['DATE'], 'IOPV': row['IOPV'][ticker]})
+    return rows
+
+
+def encode_ticker(series):
+    # raw/<ticker>/<day>: one key per tick
+    return json.dumps(dict((stamp(sec)[11:], iopv) for sec, iopv in series))
+
+
+def decode_ticker(payload):
+    return [{'DATE': f'{Day} {tm}', 'IOPV': iopv} for tm, iopv in json.loads(payload).items()]
+
+
+def encode_packed(series):
+    return json.dumps(pack_day(series))
+
+
+def decode_packed(payload):
+    return unpack_day(Day, json.loads(payload))
+
+
+def timeit(func, rounds):
+    start = time.perf_counter()
+    for i in range(rounds):
+        func()
+    return (time.perf_counter() - start) / rounds
+
+
+def main(tickers, ticks, rounds):
+    day = make_day(tickers, ticks)
+    ticker = 'ETF-0'
+    series = day[ticker]
+    print(f'{tickers} tickers x {ticks} ticks, one ticker-day read')
+
+    cases = [
+        ('market', encode_market(day), lambda x: decode_market(x, ticker)),
+        ('ticker', encode_ticker(series), decode_ticker),
+        ('packed', encode_packed(series), decode_packed),
+    ]
+    print('layout\tbytes\tdecode ms\trows')
+    for name, payload, decode in cases:
+        rows = decode(payload)
+        elapsed = timeit(lambda: decode(payload), rounds)
+        print(f'{name}\t{len(payload)}\t{elapsed * 1000:.3f}\t{len(rows)}')
+
+    # the packed rows are the unpacked ones with repeats collapsed
+    full = decode_ticker(encode_ticker(series))
+    runs = [x for i, x in enumerate(full) if i == 0 or x['IOPV'] != full[i - 1]['IOPV']]
+    packed = decode_packed(encode_packed(series))
+    assert packed[:len(runs)] == runs and packed[-1]['DATE'] == full[-1]['DATE']
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    tickers, ticks, rounds = Tickers, Ticks, Rounds
+    try:
+        opts, args = getopt.getopt(argv, 'n:r:t:')
+        Options = dict(opts)
+        if '-n' in Options.keys():
+            tickers = int(Options['-n'])
+        if '-r' in Options.keys():
+            rounds = int(Options['-r'])
+        if '-t' in Options.keys():
+            ticks = int(Options['-t'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    main(tickers, ticks, rounds)
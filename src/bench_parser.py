@@ -0,0 +1,124 @@
+import os
+import re
+import sys
+import time
+import string
+import getopt
+import resource
+import multiprocessing
+from bs4 import BeautifulSoup
+from etftable import parse_rows
+
+SampleFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '..', 'htmlsamples', 'BursaMKTPLC_ETFs.html')
+Sizes = [1000, 10000, 100000]
+LegacyMaxRows = 20000   # the BeautifulSoup path is too slow beyond this
+Repeat = 3
+
+RowTemplate = '<div class="tb_row tb_data"><div class="tb_cell tb_name">' \
+              '<a href="/mkt/themarket/etf/E{i}">ETF number {i}</a></div>' \
+              '<div class="tb_cell tb_price">1.000</div>' \
+              '<div class="tb_cell tb_chg txt_nochg">0.000</div>' \
+              '<div class="tb_cell tb_pchg txt_nochg">0.000%</div>' \
+              '<div class="tb_cell tb_volume">0</div>' \
+              '<div class="tb_cell tb_oPrice">0.000</div>' \
+              '<div class="tb_cell tb_pClose">1.000</div>' \
+              '<div class="tb_cell tb_bid">0.990</div>' \
+              '<div class="tb_cell tb_ask">1.010</div>' \
+              '<div class="tb_cell tb_iopv">{iopv}</div>' \
+              '<div class="tb_cell tb_iopvchg">0.000%</div></div>\n'
+
+
+def legacy_parse(html):
+    # the per-row BeautifulSoup path parse_rows replaced
+    soup = BeautifulSoup(html, "lxml")
+    etfs = soup.find_all(class_="tb_row tb_data")
+    rows = []
+    for row in etfs:
+        tbname = row.find(class_="tb_name")
+        tbiopv = row.find(class_="tb_iopv")
+        if tbname and tbiopv:
+            name = tbname.get_text().split('\xa0')[-1]
+            val = tbiopv.get_text()
+            iopv = re.sub(f'[^{re.escape(string.printable)}]', '', val)
+            rows.append((name, iopv))
+    return rows
+
+
+Engines = {
+    'legacy': legacy_parse,
+    'lxml': parse_rows,
+}
+
+
+def make_page(nrows):
+    # the sample page with its ETF table replaced by nrows synthetic rows
+    with open(SampleFile, encoding='utf-8') as f:
+        page = f.read()
+    if not nrows:
+        return page.encode('utf-8')
+
+    start = page.index('<span name="listing"')
+    start = page.index('>', start) + 1
+    end = page.index('</div></span>', start) + len('</div>')
+    rows = ''.join(RowTemplate.format(i=i, iopv=f'{1 + i % 1000 / 1000:.3f}')
+                   for i in range(nrows))
+    return (page[:start] + rows + page[end:]).encode('utf-8')
+
+
+def maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(engine, nrows, repeat, queue):
+    html = make_page(nrows)
+    base = maxrss()
+    start = time.perf_counter()
+    for i in range(repeat):
+        rows = Engines[engine](html)
+    elapsed = (time.perf_counter() - start) / repeat
+    queue.put((len(rows), len(html), elapsed, maxrss() - base))
+
+
+def measure(engine, nrows, repeat):
+    # each case runs in a fresh process so peak memory is not shared
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_case, args=(engine, nrows, repeat, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode:
+        raise RuntimeError(f'{engine} benchmark failed on {nrows} rows')
+    return queue.get()
+
+
+def main(sizes, repeat):
+    print('engine\trows\tpage MB\tsec/parse\trows/s\tpeak MB')
+    for nrows in [0] + sizes:
+        for engine in Engines:
+            if engine == 'legacy' and nrows > LegacyMaxRows:
+                print(f'{engine}\t{nrows}\tskipped')
+                continue
+            rows, size, elapsed, peak = measure(engine, nrows, repeat)
+            print(f'{engine}\t{rows}\t{size / 1e6:.1f}\t{elapsed:.4f}\t'
+                  f'{rows / elapsed:.0f}\t{peak / 1e6:.1f}')
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    sizes = Sizes
+    repeat = Repeat
+    try:
+        opts, args = getopt.getopt(argv, 'l:n:s:')
+        Options = dict(opts)
+        if '-s' in Options.keys():
+            sizes = [int(x) for x in Options['-s'].split(',')]
+        if '-n' in Options.keys():
+            repeat = int(Options['-n'])
+        if '-l' in Options.keys():
+            LegacyMaxRows = int(Options['-l'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    main(sizes, repeat)
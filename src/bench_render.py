@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import getopt
+import threading
+from functools import partial
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+from websession import WebSession, AllowTypes
+from iopv import TableReady, parse_html
+
+SampleDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'htmlsamples')
+SamplePage = 'BursaMKTPLC_ETFs.html'
+Rounds = 10
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(directory):
+    handler = partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def bench_profile(url, lite, rounds):
+    session = WebSession(url, max_renders=0, max_memory=0, lite=lite,
+                         allow_types=AllowTypes, allow_hosts=['127.0.0.1'])
+    times = []
+    peak = 0
+    try:
+        for i in range(rounds):
+            start = time.time()
+            html = session.render(ready=TableReady)
+            times.append(time.time() - start)
+            assert parse_html(html)
+            peak = max(peak, session.memory())
+    finally:
+        session.close()
+
+    # first render includes the browser launch, report it separately
+    launch = times[0]
+    warm = times[1:] or times
+    return {
+        'launch': launch,
+        'avg': sum(warm) / len(warm),
+        'max': max(warm),
+        'rss': peak,
+        'blocked': session.blocked,
+    }
+
+
+def main(page, rounds):
+    server = start_server(SampleDir)
+    url = f'http://127.0.0.1:{server.server_port}/{page}'
+    print(f'rendering {url} x{rounds}')
+
+    try:
+        for name, lite in (('full', False), ('lite', True)):
+            res = bench_profile(url, lite, rounds)
+            print(f"{name}:\tfirst {res['launch']:.3f}s\t"
+                  f"avg {res['avg']:.3f}s\tmax {res['max']:.3f}s\t"
+                  f"peak RSS {res['rss']:.0f} MB\tblocked {res['blocked']}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    page = SamplePage
+    rounds = Rounds
+    try:
+        opts, args = getopt.getopt(argv, 'n:p:')
+        Options = dict(opts)
+        if '-n' in Options.keys():
+            rounds = int(Options['-n'])
+        if '-p' in Options.keys():
+            page = Options['-p']
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    main(page, rounds)
@@ -1,58 +1,149 @@
-from datetime import datetime
-import time
+from datetime import datetime, timedelta
+import threading
 import re
 
-def string_to_list(strg):
-    # convert string ranges (e.g. "1,2,3-5,6") to list
-    res = sum(((list(range(*[int(b) + c
-                for c, b in enumerate(a.split('-'))]))
-                if '-' in a else [int(a)]) for a in strg.split(',')), [])
-    return res
+# (low, high) of the minute, hour, day, month and weekday fields
+FieldRanges = [(0, 59), (0, 23), (1, 31), (1, 12), (1, 7)]
+MaxSearchDays = 366 * 5     # give up looking for a match after this long
 
-def parse_field(field):
+
+def parse_field(field, low, high):
+    # convert a field (e.g. "*", "1,2,3-5", "*/15", "9-17/2") to a set
+    # of values, None means any value
     if field == '*':
-        return []
-    else:
-        return string_to_list(field)
+        return None
+
+    values = set()
+    for part in field.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+            if step < 1:
+                raise ValueError(f'invalid step in "{field}"')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = [int(x) for x in part.split('-')]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        values.update(range(start, end + 1, step))
+
+    # weekday 0 is Sunday too
+    if (low, high) == (1, 7) and 0 in values:
+        values.discard(0)
+        values.add(7)
+
+    if not values or min(values) < low or max(values) > high:
+        raise ValueError(f'"{field}" out of range {low}-{high}')
+    return frozenset(values)
+
 
 class Crontab:
-    def __init__(self, spec, job):
+    def __init__(self, spec, job, catchup='once'):
+        assert catchup in ['once', 'all', 'none']
         self.spec = spec
         self.job = job
+        self.catchup = catchup
         self.alive = True
+        self.wakeup = threading.Event()
+        self.last_slot = None
 
-        fields = re.split('[\s\|]+', spec)
+        fields = re.split(r'[\s\|]+', spec.strip())
         if len(fields) != 5:
             raise ValueError
 
-        self.minutes = parse_field(fields[0])
-        self.hours = parse_field(fields[1])
-        self.mdays = parse_field(fields[2])
-        self.months = parse_field(fields[3])
-        self.wdays = parse_field(fields[4])
+        self.minutes, self.hours, self.mdays, self.months, self.wdays = [
+            parse_field(field, low, high) for field, (low, high) in zip(fields, FieldRanges)]
+        self.minute_list = sorted(self.minutes) if self.minutes else list(range(60))
+        self.hour_list = sorted(self.hours) if self.hours else list(range(24))
+
+    def match_day(self, tm):
+        return ((not self.months or tm.month in self.months) and
+                (not self.mdays or tm.day in self.mdays) and
+                (not self.wdays or tm.isoweekday() in self.wdays))
+
+    def matches(self, tm):
+        return ((not self.minutes or tm.minute in self.minutes) and
+                (not self.hours or tm.hour in self.hours) and
+                self.match_day(tm))
+
+    def next_time(self, after):
+        # first matching minute strictly after the given time
+        tm = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = tm + timedelta(days=MaxSearchDays)
+
+        while tm < limit:
+            if self.months and tm.month not in self.months:
+                tm = tm.replace(day=1, hour=0, minute=0) + timedelta(days=32)
+                tm = tm.replace(day=1)
+                continue
+            if not self.match_day(tm):
+                tm = tm.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+
+            # jump to the next allowed hour and minute within this day
+            hours = [h for h in self.hour_list if h >= tm.hour]
+            if not hours:
+                tm = tm.replace(hour=0, minute=0) + timedelta(days=1)
+                continue
+            if hours[0] != tm.hour:
+                tm = tm.replace(hour=hours[0], minute=0)
+
+            minutes = [m for m in self.minute_list if m >= tm.minute]
+            if minutes:
+                return tm.replace(minute=minutes[0])
+            tm = tm.replace(minute=0) + timedelta(hours=1)
+
+        raise ValueError(f'no time matches "{self.spec}"')
+
+    def sleep_until(self, tm):
+        # wake up at tm, or earlier if stop() is called
+        while self.alive:
+            wait = (tm - datetime.now()).total_seconds()
+            if wait <= 0:
+                return True
+            self.wakeup.wait(wait)
+        return False
+
+    def fire(self, slot, showtime):
+        self.last_slot = slot
+        if showtime:
+            date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            print(f"\n[{date}]")
+        self.job()
 
     def run(self, showtime=False):
         self.alive = True
+        self.wakeup.clear()
 
-        while self.alive:
-            tm = datetime.now()
-
-            if tm.second >= 1:
-                pass
-            elif ((not self.minutes or tm.minute in self.minutes) and
-                    (not self.hours or tm.hour in self.hours) and
-                    (not self.mdays or tm.day in self.mdays) and
-                    (not self.months or tm.month in self.months) and
-                    (not self.wdays or tm.isoweekday() in self.wdays)):
-                if showtime:
-                    date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    print(f"\n[{date}]")
-                self.job()
-
-            time.sleep(1)
+        slot = self.next_time(datetime.now())
+        while self.sleep_until(slot):
+            self.fire(slot, showtime)
+
+            # slots missed while the job ran (or the host was suspended)
+            # are handled by the catch-up policy, always in slot order
+            now = datetime.now()
+            slot = self.next_time(slot)
+            missed = []
+            while slot <= now:
+                missed.append(slot)
+                slot = self.next_time(slot)
+
+            if missed and self.catchup == 'once':
+                missed = missed[-1:]
+            elif self.catchup == 'none':
+                missed = []
+            for tm in missed:
+                if not self.alive:
+                    break
+                self.fire(tm, showtime)
 
     def stop(self):
         self.alive = False
+        self.wakeup.set()
+
 
 if __name__ == "__main__":
     def test_job():
@@ -0,0 +1,47 @@
+from lxml import etree
+import re
+import string
+
+# compiled once, shared by every parse
+NonPrintable = re.compile(f'[^{re.escape(string.printable)}]')
+RowPath = etree.XPath('//*[@class="tb_row tb_data"]')
+TextOf = etree.XPath('string()')
+HtmlParser = etree.HTMLParser(remove_comments=True, remove_pis=True,
+                              no_network=True, recover=True)
+
+
+def find_cells(row):
+    # first tb_name and tb_iopv elements below a table row
+    tbname = tbiopv = None
+    for elem in row.iterdescendants():
+        cls = elem.get('class')
+        if not cls:
+            continue
+        classes = cls.split()
+        if tbname is None and 'tb_name' in classes:
+            tbname = elem
+        elif tbiopv is None and 'tb_iopv' in classes:
+            tbiopv = elem
+        if tbname is not None and tbiopv is not None:
+            break
+    return tbname, tbiopv
+
+
+def parse_rows(html):
+    # return [(name, iopv_text), ...] from the ETF table rows of a page
+    if isinstance(html, str):
+        html = html.encode('utf-8')
+    root = etree.fromstring(html, HtmlParser)
+    if root is None:
+        return []
+
+    rows = []
+    for row in RowPath(root):
+        tbname, tbiopv = find_cells(row)
+        if tbname is not None and tbiopv is not None:
+            name = TextOf(tbname).split('\xa0')[-1]
+            iopv = NonPrintable.sub('', TextOf(tbiopv))
+            rows.append((name, iopv))
+
+    return rows
+
@@ -0,0 +1,354 @@
+import sys
+import json
+import time
+import getopt
+import random
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+Host = '127.0.0.1'
+ConfigFile = 'emulator_config.json'     # never the real firebase_config.json
+PushChars = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+def key_order(key):
+    # integer keys first, in numeric order, then the rest as strings
+    if key.lstrip('-').isdigit() and -2 ** 31 <= int(key) < 2 ** 31:
+        return (0, int(key), '')
+    return (1, 0, key)
+
+
+def value_order(value):
+    # null, false, true, numbers, strings, then objects
+    if value is None:
+        return (0, 0, '')
+    if isinstance(value, bool):
+        return (1, int(value), '')
+    if isinstance(value, (int, float)):
+        return (2, value, '')
+    if isinstance(value, str):
+        return (3, 0, value)
+    return (4, 0, '')
+
+
+def to_tree(value):
+    # arrays are stored as objects keyed by index, null and empty
+    # objects are no value at all
+    if isinstance(value, list):
+        value = dict((str(i), x) for i, x in enumerate(value))
+    if isinstance(value, dict):
+        node = {}
+        for k, v in value.items():
+            v = to_tree(v)
+            if v is not None:
+                node[str(k)] = v
+        return node or None
+    return value
+
+
+def to_json(node):
+    # objects keyed 0..n, at least half of them set, go back as arrays
+    if not isinstance(node, dict):
+        return node
+    data = dict((k, to_json(v)) for k, v in node.items())
+    if all(k.isdigit() for k in data):
+        size = max(int(k) for k in data) + 1
+        if len(data) * 2 > size:
+            return [data.get(str(i)) for i in range(size)]
+    return data
+
+
+def etag(value):
+    return hashlib.md5(json.dumps(value, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class FireEmulator:
+    # in-memory stand-in for the Realtime Database REST API, the part
+    # Firework uses: GET with orderBy/startAt/endAt/equalTo/limitToFirst/
+    # limitToLast/shallow, PUT (with if-match), PATCH (multi-location),
+    # POST (push) and DELETE. Security rules, indexes, auth and
+    # streaming are not emulated. Every request is counted in stats.
+    def __init__(self, data=None, host=Host, port=0):
+        self.root = to_tree(data) or {}
+        self.lock = threading.Lock()
+        self.stats = []     # (method, path, status, bytes in, bytes out)
+        self.last_push = (0, [])
+        self.server = ThreadingHTTPServer((host, port), EmulatorHandler)
+        self.server.emulator = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def config(self):
+        return {'apiKey': 'emulator', 'authDomain': 'localhost',
+                'databaseURL': self.url, 'storageBucket': 'localhost'}
+
+    def write_config(self, config_file=ConfigFile):
+        # a config file for Firework(config_file)
+        with open(config_file, 'w') as f:
+            json.dump({'firebase_connect': self.config()}, f, indent=4)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fireemu', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def counters(self):
+        # requests, bytes in and bytes out so far
+        stats = list(self.stats)
+        return len(stats), sum(x[3] for x in stats), sum(x[4] for x in stats)
+
+    def node(self, parts):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def get(self, parts):
+        with self.lock:
+            return to_json(self.node(parts))
+
+    def put(self, parts, value):
+        # write value at parts, pruning objects left empty
+        if not parts:
+            self.root = to_tree(value) or {}
+            return
+        value = to_tree(value)
+        node, trail = self.root, []
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                if value is None:
+                    return
+                node[part] = {}
+            trail.append((node, part))
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+        for parent, part in reversed(trail):
+            if parent[part]:
+                break
+            del parent[part]
+
+    def set(self, parts, value, if_match=None):
+        # returns (ok, current value)
+        with self.lock:
+            if if_match is not None and if_match != etag(to_json(self.node(parts))):
+                return False, to_json(self.node(parts))
+            self.put(parts, value)
+            return True, value
+
+    def update(self, parts, data):
+        paths = sorted([x for x in key.split('/') if x] for key in data)
+        for a, b in zip(paths, paths[1:]):
+            if b[:len(a)] == a:
+                raise ValueError(f"Path '{'/'.join(a)}' is an ancestor of '{'/'.join(b)}'")
+        with self.lock:
+            for key, value in data.items():
+                self.put(parts + [x for x in key.split('/') if x], value)
+
+    def push_id(self):
+        # time ordered like the real ones: 8 chars of milliseconds, then
+        # 12 random chars, incremented within the same millisecond
+        now = int(time.time() * 1000)
+        last, tail = self.last_push
+        if now == last:
+            for i in range(11, -1, -1):
+                if tail[i] != 63:
+                    tail[i] += 1
+                    break
+                tail[i] = 0
+        else:
+            tail = [random.randrange(64) for i in range(12)]
+        self.last_push = (now, tail)
+        head = ''
+        for i in range(8):
+            head = PushChars[now % 64] + head
+            now //= 64
+        return head + ''.join(PushChars[x] for x in tail)
+
+    def push(self, parts, value):
+        with self.lock:
+            key = self.push_id()
+            self.put(parts + [key], value)
+            return key
+
+    def query(self, parts, params):
+        with self.lock:
+            node = self.node(parts)
+            if 'shallow' in params and params['shallow'] == 'true':
+                return dict((k, True) for k in node) if isinstance(node, dict) else node
+            if 'orderBy' not in params or not isinstance(node, dict):
+                return to_json(node)
+
+            order_by = json.loads(params['orderBy'])
+            if order_by == '$key':
+                def order(key, value):
+                    return key_order(key)
+
+                def bound(x):
+                    return key_order(str(x))
+            else:
+                child = [x for x in order_by.split('/') if x] if order_by != '$value' else []
+
+                def order(key, value):
+                    for part in child:
+                        value = value.get(part) if isinstance(value, dict) else None
+                    return value_order(to_json(value)), key_order(key)
+
+                def bound(x):
+                    return (value_order(x),)
+
+            items = sorted(node.items(), key=lambda x: order(*x))
+            start = params.get('startAt', params.get('equalTo'))
+            end = params.get('endAt', params.get('equalTo'))
+            if start is not None:
+                low = bound(json.loads(start))
+                items = [x for x in items if order(*x)[:len(low)] >= low]
+            if end is not None:
+                high = bound(json.loads(end))
+                items = [x for x in items if order(*x)[:len(high)] <= high]
+            if 'limitToFirst' in params:
+                items = items[:int(params['limitToFirst'])]
+            if 'limitToLast' in params:
+                items = items[-int(params['limitToLast']):] if int(params['limitToLast']) else []
+            return dict((k, to_json(v)) for k, v in items)
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True      # else small replies wait on delayed ACKs
+
+    def log_message(self, format, *args):
+        pass
+
+    def target(self):
+        url = urlparse(self.path)
+        path = url.path[:-len('.json')] if url.path.endswith('.json') else url.path
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.bytes_in = 0
+        return [x for x in path.split('/') if x], params
+
+    def body(self):
+        size = int(self.headers.get('Content-Length') or 0)
+        self.bytes_in = size
+        return json.loads(self.rfile.read(size)) if size else None
+
+    def reply(self, status, value, headers={}):
+        data = json.dumps(value).encode('utf-8')
+        # counted before the reply goes out, so a client sees its request
+        # in stats as soon as the response arrives
+        self.server.emulator.stats.append((self.command, urlparse(self.path).path, status,
+                                           self.bytes_in, len(data)))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, header in headers.items():
+            self.send_header(name, header)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts, params = self.target()
+        value = self.server.emulator.query(parts, params)
+        headers = {}
+        if self.headers.get('X-Firebase-ETag') == 'true':
+            headers['ETag'] = etag(value)
+        self.reply(200, value, headers)
+
+    def do_PUT(self):
+        parts, params = self.target()
+        value = self.body()
+        ok, current = self.server.emulator.set(parts, value, self.headers.get('if-match'))
+        if not ok:
+            self.reply(412, current, {'ETag': etag(current)})
+            return
+        self.reply(200, value, {'ETag': etag(value)})
+
+    def do_PATCH(self):
+        parts, params = self.target()
+        data = self.body()
+        if not isinstance(data, dict):
+            self.reply(400, {'error': 'Invalid data; couldn\'t parse JSON object.'})
+            return
+        try:
+            self.server.emulator.update(parts, data)
+        except ValueError as err:
+            self.reply(400, {'error': str(err)})
+            return
+        self.reply(200, data)
+
+    def do_POST(self):
+        parts, params = self.target()
+        key = self.server.emulator.push(parts, self.body())
+        self.reply(200, {'name': key})
+
+    def do_DELETE(self):
+        parts, params = self.target()
+        self.server.emulator.set(parts, None)
+        self.reply(200, None)
+
+
+if __name__ == "__main__":
+    # serve on localhost until interrupted, e.g.
+    #   fireemu.py -p 9000 -f snapshot.json -c emulator_config.json
+    argv = sys.argv[1:]
+    port = 0
+    data_file = None
+    config_file = None
+    try:
+        opts, args = getopt.getopt(argv, 'c:f:p:')
+        Options = dict(opts)
+        if '-p' in Options.keys():
+            port = int(Options['-p'])
+        if '-f' in Options.keys():
+            data_file = Options['-f']
+        if '-c' in Options.keys():
+            config_file = Options['-c']
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    data = None
+    if data_file:
+        try:
+            with open(data_file) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            pass
+
+    emulator = FireEmulator(data, port=port)
+    if config_file:
+        emulator.write_config(config_file)
+    print(f'serving {emulator.url}')
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.server.server_close()
+        if data_file:
+            with open(data_file, 'w') as f:
+                json.dump(to_json(emulator.root), f)
+        print(f'{len(emulator.stats)} requests served')
@@ -0,0 +1,216 @@
+import sys
+import time
+import getopt
+import sqlite3
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from fireworks import Firework, raw_db, daily_db, ohlc_fields, columns_result
+from utils import statefile
+
+MirrorFile = statefile('iopv-mirror.sqlite')
+MirrorTTL = 60          # seconds a synced tree is served without syncing
+SyncPage = 1000         # records fetched per request while syncing
+SyncWindow = 900        # seconds before the last key synced again, for
+                        # ticks the write-behind queue sends late
+
+Schema = """
+CREATE TABLE IF NOT EXISTS raw (
+    date TEXT NOT NULL, ticker TEXT NOT NULL, iopv,
+    PRIMARY KEY (ticker, date));
+CREATE INDEX IF NOT EXISTS raw_date ON raw (date);
+CREATE TABLE IF NOT EXISTS daily (
+    date TEXT NOT NULL, ticker TEXT NOT NULL, open, high, low, close,
+    PRIMARY KEY (ticker, date));
+CREATE INDEX IF NOT EXISTS daily_date ON daily (date);
+CREATE TABLE IF NOT EXISTS sync (
+    tree TEXT PRIMARY KEY, last_key TEXT, synced REAL);
+"""
+
+
+def window_start(key, window):
+    # key, a date or a timestamp, moved back by window seconds; a day
+    # key moves back to the day before
+    if not key:
+        return key
+    form = "%Y-%m-%d %H:%M:%S" if len(key) > 10 else "%Y-%m-%d"
+    try:
+        stamp = datetime.datetime.strptime(key, form)
+    except ValueError:
+        return key
+    return (stamp - datetime.timedelta(seconds=window)).strftime(form)
+
+
+class FireMirror:
+    # local SQLite copy of the raw and daily trees. Each tree remembers
+    # the last key synced; a sync fetches everything after it and the
+    # keys of the window seconds before it again: the day being written
+    # still changes, and ticks replayed late from a FireQueue log carry
+    # older timestamps than ones already synced. Reads sync the tree
+    # first when it is older than ttl seconds, then run locally.
+    def __init__(self, fire, db_file=MirrorFile, ttl=MirrorTTL):
+        self.fire = fire
+        self.db_file = db_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.executescript(Schema)
+
+    def state(self, tree):
+        row = self.conn.execute('SELECT last_key, synced FROM sync WHERE tree = ?', (tree,)).fetchone()
+        return row if row else (None, 0)
+
+    def store(self, tree, rows):
+        if tree == raw_db:
+            values = [(row['DATE'], ticker, iopv) for row in rows.values()
+                      for ticker, iopv in row.get('IOPV', {}).items()]
+            self.conn.executemany('INSERT OR REPLACE INTO raw VALUES (?, ?, ?)', values)
+        else:
+            values = [(row['DATE'], ticker, *[bar.get(x) for x in ohlc_fields])
+                      for row in rows.values() for ticker, bar in row.get('IOPV', {}).items()]
+            self.conn.executemany('INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?)', values)
+
+    def sync(self, tree, force=False, window=SyncWindow):
+        # returns the number of records fetched
+        with self.lock:
+            last_key, synced = self.state(tree)
+            if not force and time.time() - synced < self.ttl:
+                return 0
+
+            count = 0
+            now = time.time()
+            start_key = window_start(last_key, window)
+            for rows in self.fire.iter_pages(tree, SyncPage, start_key, inclusive=True):
+                self.store(tree, rows)
+                last_key = list(rows)[-1]
+                count += len(rows)
+                # keep what is fetched so far if the sync is interrupted
+                self.conn.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)',
+                                  (tree, last_key, synced))
+                self.conn.commit()
+
+            self.conn.execute('INSERT OR REPLACE INTO sync VALUES (?, ?, ?)', (tree, last_key, now))
+            self.conn.commit()
+            return count
+
+    def query(self, sql, params):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def since(self, table, last):
+        # first date of the last 'last' keys of a tree
+        row = self.query(f'SELECT MIN(date) FROM (SELECT DISTINCT date FROM {table} '
+                         f'ORDER BY date DESC LIMIT ?)', (last,))
+        return row[0][0] if row else None
+
+    def select(self, table, columns, tickers, last, start=None, end=None):
+        sql = f'SELECT date, ticker, {columns} FROM {table}'
+        where, params = [], []
+        if last >= 0:
+            where.append('date >= ?')
+            params.append(self.since(table, last) or '')
+        if start:
+            where.append('date >= ?')
+            params.append(start)
+        if end:
+            # an inclusive prefix, '~' sorts after any date or time
+            where.append('date <= ?')
+            params.append(f'{end}~')
+        if tickers:
+            tickers = list(tickers)
+            where.append(f"ticker IN ({','.join('?' * len(tickers))})")
+            params.extend(tickers)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.query(sql + ' ORDER BY date', params)
+
+    def make_result(self, records, fields, result):
+        # [(date, ticker, value, ...), ...] in date order to the same
+        # results as Firework's readers
+        if result == 'rows':
+            stock_data = {}
+            for date, ticker, *values in records:
+                if fields == ['IOPV']:
+                    row = {'DATE': date, 'IOPV': values[0]}
+                else:
+                    row = {**dict(zip(fields, values)), 'DATE': date}
+                stock_data.setdefault(ticker, []).append(row)
+            return stock_data
+
+        series = {}
+        for date, ticker, *values in records:
+            series.setdefault(ticker, []).append((date, *values))
+        chunks = {}
+        for ticker, rows in series.items():
+            cols = list(zip(*rows))
+            chunk = {'DATE': np.array(cols[0], dtype='datetime64[s]')}
+            for field, values in zip(fields, cols[1:]):
+                chunk[field] = pd.to_numeric(values, errors='coerce').astype('float64')
+            chunks[ticker] = [chunk]
+        return columns_result(chunks, result)
+
+    def get_stock_raw(self, tickers, last=100, result='rows'):
+        self.sync(raw_db)
+        return self.make_result(self.select('raw', 'iopv', tickers, last), ['IOPV'], result)
+
+    def get_stock_daily(self, tickers, last=100, result='rows'):
+        self.sync(daily_db)
+        records = self.select('daily', 'open, high, low, close', tickers, last)
+        return self.make_result(records, list(ohlc_fields), result)
+
+    def read_range(self, tickers, start=None, end=None, daily=False, result='rows'):
+        if daily:
+            self.sync(daily_db)
+            records = self.select('daily', 'open, high, low, close', tickers, -1, start, end)
+            return self.make_result(records, list(ohlc_fields), result)
+        self.sync(raw_db)
+        records = self.select('raw', 'iopv', tickers, -1, start, end)
+        return self.make_result(records, ['IOPV'], result)
+
+    def get_ticker_raw(self, tickers, days, last=-1, result='rows'):
+        # each ticker's ticks of its last 'days' trading days
+        self.sync(raw_db)
+        records = []
+        for ticker in tickers:
+            day = self.query('SELECT MIN(day) FROM (SELECT DISTINCT substr(date, 1, 10) AS day '
+                             'FROM raw WHERE ticker = ? ORDER BY day DESC LIMIT ?)', (ticker, days))
+            rows = self.query('SELECT date, ticker, iopv FROM raw WHERE ticker = ? AND date >= ? '
+                              'ORDER BY date', (ticker, day[0][0] or ''))
+            records.extend(rows[-last:] if last > 0 else rows)
+        records.sort(key=lambda x: x[0])
+        return self.make_result(records, ['IOPV'], result)
+
+    def get_day_raw(self, date):
+        # [(timestamp, ticker, iopv), ...] of one day
+        self.sync(raw_db)
+        end = str(datetime.date.fromisoformat(date) + datetime.timedelta(1))
+        return self.query('SELECT date, ticker, iopv FROM raw WHERE date >= ? AND date < ? '
+                          'ORDER BY date', (date, end))
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    # bring the mirror up to date, e.g. from cron before chart builds;
+    # -w <seconds> syncs a longer window again, e.g. after an outage
+    argv = sys.argv[1:]
+    mirror_file = MirrorFile
+    window = SyncWindow
+    try:
+        opts, args = getopt.getopt(argv, 'm:w:')
+        Options = dict(opts)
+        if '-m' in Options.keys():
+            mirror_file = Options['-m']
+        if '-w' in Options.keys():
+            window = int(Options['-w'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    fire = Firework(mirror_file=mirror_file)
+    for tree in (raw_db, daily_db):
+        start = time.time()
+        count = fire.mirror.sync(tree, force=True, window=window)
+        print(f'{tree}: {count} records synced in {time.time() - start:.1f}s')
@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import time
+import getopt
+import threading
+from datetime import datetime
+from fireworks import Firework
+from utils import statefile
+
+WalFile = statefile('iopv-wal.jsonl')
+FlushEntries = 100      # log entries merged into one batch
+FlushInterval = 5       # seconds between flushes when idle
+MaxBackoff = 300        # seconds, longest wait after failed flushes
+CompactSize = 1 << 20   # bytes, drained log is truncated past this size
+
+
+class FireQueue:
+    # write-behind queue in front of Firework. Updates are appended to a
+    # local write-ahead log and return at once, a background thread
+    # replays them into Firework in batches. The log offset of the last
+    # flushed entry is kept in <wal_file>.pos, so entries that were not
+    # flushed before a crash are sent on the next start. Replaying an
+    # entry twice is harmless, every write is keyed by its timestamp.
+    def __init__(self, wal_file=WalFile, batch_size=FlushEntries,
+                 interval=FlushInterval, firework=Firework):
+        self.wal_file = wal_file
+        self.pos_file = f'{wal_file}.pos'
+        self.batch_size = batch_size
+        self.interval = interval
+        self.firework = firework
+        self.fire = None
+        self.resolver = None
+        self.lock = threading.Lock()
+        self.flushing = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.alive = False
+        self.failures = 0
+        self.flushed = 0
+        self.pos = self.load_pos()
+
+    def load_pos(self):
+        if not os.path.isfile(self.pos_file):
+            return 0
+        with open(self.pos_file) as f:
+            pos = int(f.read().strip() or 0)
+        # a crash while truncating the log leaves the old offset behind
+        if not os.path.isfile(self.wal_file) or pos > os.path.getsize(self.wal_file):
+            return 0
+        return pos
+
+    def save_pos(self, pos):
+        tmp_file = f'{self.pos_file}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(str(pos))
+        os.replace(tmp_file, self.pos_file)
+        self.pos = pos
+
+    def put(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self.lock:
+            with open(self.wal_file, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        self.wakeup.set()
+
+    def update_iopv_list(self, iopv_list, logtime=None):
+        now = logtime if logtime else datetime.now()
+        self.put({'OP': 'iopv', 'DATE': now.strftime("%Y-%m-%d %H:%M:%S"),
+                  'IOPV': [[stock, iopv] for stock, iopv in iopv_list]})
+
+    def resolve_ticker(self, stock):
+        # from Firebase's shared stock list at once, so other stores can
+        # write the ticker before the entry is flushed
+        if self.resolver is None:
+            self.resolver = self.firework()
+        return self.resolver.resolve_ticker(stock)
+
+    def heartbeat(self, changed, logtime=None):
+        now = logtime if logtime else datetime.now()
+        self.put({'OP': 'heartbeat', 'DATE': now.strftime("%Y-%m-%d %H:%M:%S"),
+                  'CHANGED': changed})
+
+    def read(self):
+        # next complete entries after the flushed offset and the offset
+        # past them, a torn last line from a crash is left for later
+        entries = []
+        pos = self.pos
+        if not os.path.isfile(self.wal_file):
+            return entries, pos
+        with open(self.wal_file, 'rb') as f:
+            f.seek(pos)
+            while len(entries) < self.batch_size:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                pos += len(line)
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    print(f'WAL: skipping bad entry at {pos - len(line)}', file=sys.stderr)
+        return entries, pos
+
+    def pending(self):
+        if not os.path.isfile(self.wal_file):
+            return 0
+        return os.path.getsize(self.wal_file) - self.pos
+
+    def apply(self, batch, entry):
+        logtime = datetime.strptime(entry['DATE'], "%Y-%m-%d %H:%M:%S")
+        if entry['OP'] == 'iopv':
+            self.fire.update_iopv_list(entry['IOPV'], logtime=logtime, batch=batch)
+        elif entry['OP'] == 'heartbeat':
+            self.fire.heartbeat(entry['CHANGED'], logtime=logtime, batch=batch)
+        else:
+            print(f"WAL: unknown entry {entry['OP']}", file=sys.stderr)
+
+    def flush_once(self):
+        # send the next batch of entries, writes to the same path are
+        # merged in the batch so only the latest value goes out
+        entries, pos = self.read()
+        if not entries:
+            if pos != self.pos:
+                self.save_pos(pos)
+            return 0
+
+        if self.fire is None:
+            self.fire = self.firework()
+        batch = self.fire.batch()
+        try:
+            for entry in entries:
+                self.apply(batch, entry)
+            batch.commit()
+        except Exception:
+            # forget the running OHLC, it counted ticks that were not sent
+            self.fire.ohlc = None
+            raise
+        if self.fire.ohlc:
+            self.fire.ohlc.save()
+        self.save_pos(pos)
+        self.flushed += len(entries)
+        self.compact()
+        return len(entries)
+
+    def compact(self):
+        # start a new log once everything in it has been flushed
+        with self.lock:
+            if self.pos < CompactSize or self.pending():
+                return
+            open(self.wal_file, 'w').close()
+            self.save_pos(0)
+
+    def flush(self):
+        # drain the log, returns the number of entries sent
+        count = 0
+        with self.flushing:
+            while True:
+                n = self.flush_once()
+                if not n:
+                    return count
+                count += n
+
+    def run(self):
+        while self.alive:
+            self.wakeup.clear()
+            try:
+                self.flush()
+                self.failures = 0
+                wait = self.interval
+            except Exception as err:
+                # the entries stay in the log, back off and try again
+                self.failures += 1
+                wait = min(self.interval * 2 ** self.failures, MaxBackoff)
+                print(f'WAL: flush failed ({err!r}), {self.pending()} bytes pending, '
+                      f'retry in {wait}s', file=sys.stderr)
+            self.wakeup.wait(wait)
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name='firequeue', daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=30):
+        # one last try to drain the log before exiting
+        self.alive = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+        try:
+            self.flush()
+        except Exception as err:
+            print(f'WAL: {self.pending()} bytes left unflushed ({err!r})', file=sys.stderr)
+
+
+if __name__ == "__main__":
+    # flush a log left behind by a daemon
+    argv = sys.argv[1:]
+    wal_file = WalFile
+    try:
+        opts, args = getopt.getopt(argv, 'q:')
+        Options = dict(opts)
+        if '-q' in Options.keys():
+            wal_file = Options['-q']
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    queue = FireQueue(wal_file)
+    print(f'{queue.pending()} bytes pending')
+    start = time.time()
+    count = queue.flush()
+    print(f'{count} entries flushed in {time.time() - start:.1f}s')
@@ -1,128 +1,821 @@
+import os
 import sys
+import copy
+import time
 import getopt
+import gzip
+import hashlib
 import json
-import csv
 import pyrebase
 from pprint import pprint
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 from pandas import to_datetime
+import numpy as np
 import pandas as pd
+from utils import statefile, save_json
 
 
 firebase_config_file = 'firebase_config.json'
 daily_db = 'iopv-daily'
 raw_db = 'iopv-raw'
+shard_db = 'raw'                # raw/<ticker>/<day>/<HH:MM:SS> = iopv
+packed_db = 'raw-packed'        # raw-packed/<ticker>/<day> = {T, V, END}
+raw_layouts = ('market', 'ticker')  # any of 'market' (raw_db), 'ticker'
+                                    # (shard_db) and 'packed' (packed_db)
+shard_days = 3                  # days of ticks read per ticker
+shard_workers = 8               # tickers read at the same time
+heartbeat_db = 'iopv-heartbeat'
+log_db = 'iopv-log'
+stock_list_db = 'stock-list'
+stock_meta_db = 'stock-list-meta'
+stock_cache_file = statefile('stock-list-cache.json')
+stock_cache_ttl = 600           # seconds the cached stock list is trusted
+tx_retries = 25                 # attempts of a conditional write
+purge_page = 500                # records read per page while purging
+import_rows = 2000              # rows per uploaded chunk
+import_workers = 4              # chunks uploaded at the same time
+import_retries = 5              # attempts per chunk
+stream_page = 1000              # records per page of a streaming read
+ohlc_fields = ('OPEN', 'HIGH', 'LOW', 'CLOSE')
+ohlc_state_file = statefile('iopv-ohlc.json')
+batch_size = 500        # paths per multi-location PATCH
 
 
-def trim_leading_iopv(df):
-    for i in range(len(df) - 1):
-        iopv1 = df.iloc[i]['IOPV']
-        iopv2 = df.iloc[i + 1]['IOPV']
-        if iopv1 != iopv2:
-            return df[i + 1:]
-    else:
-        return df
+def daily_ohlc(df):
+    # daily bars for any number of tickers and days in one pass.
+    # df has DATE, TICKER and IOPV columns; the result has one row per
+    # TICKER and DAY with OPEN, HIGH, LOW, CLOSE, plus FIRST (the day's
+    # first price), LEADING (no other price seen yet) and LAST (time of
+    # the last tick), VALUE (the last price) and RUNS (runs of unchanged
+    # prices). The leading run of the day's first price, i.e. the
+    # previous day's carry-over, is dropped once a different price shows
+    # up. Prices that are not numbers (e.g. '-') are ignored.
+    dates = pd.to_datetime(df['DATE'])
+    iopv = pd.to_numeric(df['IOPV'], errors='coerce')
+    data = pd.DataFrame({'TICKER': df['TICKER'].values, 'DATE': dates.values,
+                         'IOPV': iopv.values})
+    data = data[data['IOPV'].notna()]
+    data['DAY'] = data['DATE'].dt.normalize()
+    data = data.sort_values(['TICKER', 'DAY', 'DATE'], kind='stable')
 
+    keys = [data['TICKER'], data['DAY']]
+    first = data.groupby(keys, sort=False)['IOPV'].transform('first')
+    seen = (data['IOPV'] != first).groupby(keys, sort=False).cummax()
+    moved = seen.groupby(keys, sort=False).transform('max')
+    data['KEEP'] = seen | ~moved
+    data['MOVED'] = moved
+    data['RUN'] = data['IOPV'] != data.groupby(keys, sort=False)['IOPV'].shift()
 
-def get_ohlc(ilist):
-    df = pd.DataFrame(ilist)
-    dfs = df.sort_values(by='DATE', ascending=True)
-    dft = trim_leading_iopv(dfs)
-    op = dft.iloc[0]['IOPV']
-    cl = dft.iloc[-1]['IOPV']
-    hi = dft['IOPV'].max()
-    lo = dft['IOPV'].min()
-    return op, hi, lo, cl
+    groups = data.groupby(['TICKER', 'DAY'], sort=True)
+    info = groups.agg(FIRST=('IOPV', 'first'), LAST=('DATE', 'last'),
+                      VALUE=('IOPV', 'last'), RUNS=('RUN', 'sum'),
+                      MOVED=('MOVED', 'first'))
+    kept = data[data['KEEP']].groupby(['TICKER', 'DAY'], sort=True)['IOPV']
+    bars = kept.agg(OPEN='first', HIGH='max', LOW='min', CLOSE='last').join(info)
+    bars['LEADING'] = ~bars.pop('MOVED')
+    return bars.reset_index()
+
+
+def pack_day(ticks):
+    # [(seconds of the day, iopv), ...] in time order to the packed form:
+    # T and V hold the start time and price of each run of unchanged
+    # prices, END the time of the last tick
+    times, values = [], []
+    for sec, iopv in ticks:
+        if not values or iopv != values[-1]:
+            times.append(sec)
+            values.append(iopv)
+    return {'T': times, 'V': values, 'END': ticks[-1][0]} if ticks else None
+
+
+def unpack_day(day, node):
+    # back to [{'DATE', 'IOPV'}, ...], one row per run and one for the
+    # last tick. Arrays written by index can come back as dicts.
+    def array(x):
+        if isinstance(x, dict):
+            return [x[k] for k in sorted(x, key=int)]
+        return [v for v in x if v is not None]
+
+    def stamp(sec):
+        return f'{day} {sec // 3600:02d}:{sec // 60 % 60:02d}:{sec % 60:02d}'
+
+    times, values = array(node.get('T', [])), array(node.get('V', []))
+    rows = [{'DATE': stamp(sec), 'IOPV': iopv} for sec, iopv in zip(times, values)]
+    end = node.get('END')
+    if rows and end is not None and end > times[-1]:
+        rows.append({'DATE': stamp(end), 'IOPV': values[-1]})
+    return rows
+
+
+class OhlcAccumulator:
+    # running daily OHLC per ticker, updated in O(1) for each new IOPV.
+    # As in daily_ohlc(), the leading run of the day's first price (the
+    # previous day's carry-over) is dropped once a different price shows up.
+    def __init__(self, state_file=ohlc_state_file):
+        self.state_file = state_file
+        self.date = None
+        self.bars = {}
+        self.load()
+
+    def load(self):
+        if not self.state_file or not os.path.isfile(self.state_file):
+            return
+        with open(self.state_file) as f:
+            state = json.load(f)
+        self.date = state['DATE']
+        self.bars = state['BARS']
+        for bar in self.bars.values():
+            bar.setdefault('VALUE', bar['CLOSE'])
+            bar.setdefault('RUNS', 1)
+
+    def save(self):
+        if not self.state_file:
+            return
+        save_json(self.state_file, {'DATE': self.date, 'BARS': self.bars})
+
+    def reset(self, date):
+        self.date = date
+        self.bars = {}
+
+    def replay(self, date, rows):
+        # start the day over from its ticks [(timestamp, ticker, iopv), ...]
+        self.reset(date)
+        if not rows:
+            return
+
+        bars = daily_ohlc(pd.DataFrame(rows, columns=['DATE', 'TICKER', 'IOPV']))
+        for bar in bars.itertuples(index=False):
+            self.bars[bar.TICKER] = {
+                'FIRST': float(bar.FIRST), 'LEADING': bool(bar.LEADING),
+                'LAST': bar.LAST.strftime("%Y-%m-%d %H:%M:%S"),
+                'OPEN': float(bar.OPEN), 'HIGH': float(bar.HIGH),
+                'LOW': float(bar.LOW), 'CLOSE': float(bar.CLOSE),
+                'VALUE': float(bar.VALUE), 'RUNS': int(bar.RUNS)}
+
+    def add(self, ticker, timestamp, iopv):
+        # returns True when iopv starts a new run of unchanged prices
+        if not isinstance(iopv, (int, float)) or iopv != iopv:
+            return False
+        bar = self.bars.get(ticker)
+        if bar is None:
+            self.bars[ticker] = {'FIRST': iopv, 'LEADING': True, 'LAST': timestamp,
+                                 'OPEN': iopv, 'HIGH': iopv, 'LOW': iopv, 'CLOSE': iopv,
+                                 'VALUE': iopv, 'RUNS': 1}
+            return True
+
+        # ticks already counted (e.g. replayed on a cold start) are ignored
+        if timestamp <= bar['LAST']:
+            return False
+        bar['LAST'] = timestamp
+
+        if bar['LEADING']:
+            if iopv != bar['FIRST']:
+                bar['LEADING'] = False
+                bar['OPEN'] = bar['HIGH'] = bar['LOW'] = bar['CLOSE'] = iopv
+        else:
+            bar['HIGH'] = max(bar['HIGH'], iopv)
+            bar['LOW'] = min(bar['LOW'], iopv)
+            bar['CLOSE'] = iopv
+
+        if iopv == bar['VALUE']:
+            return False
+        bar['VALUE'] = iopv
+        bar['RUNS'] += 1
+        return True
+
+    def ohlc(self, ticker):
+        bar = self.bars[ticker]
+        return dict((x, bar[x]) for x in ('OPEN', 'HIGH', 'LOW', 'CLOSE'))
+
+    def daily(self):
+        return dict((ticker, self.ohlc(ticker)) for ticker in self.bars)
+
+
+def transaction(db, path, func, retries=tx_retries):
+    # read-modify-write of one node with the REST API's ETag and
+    # conditional PUT, func(value) returns the new value and is called
+    # again with the current value whenever another writer got in first
+    current = db.child(path).get_etag()
+    value, etag = current['value'], current['ETag']
+
+    for i in range(retries):
+        new_value = func(value)
+        result = db.child(path).conditional_set(new_value, etag)
+        # a mismatch returns the current ETag and value to try again with
+        if isinstance(result, dict) and set(result) == {'ETag', 'value'} and result != new_value:
+            value, etag = result['value'], result['ETag']
+            continue
+        return new_value
+
+    raise RuntimeError(f'[ERROR] transaction on {path} failed after {retries} attempts')
+
+
+class StockListCache:
+    # STOCK -> TICKER map of the stock-list node with a reverse index,
+    # kept in a local snapshot. The snapshot is trusted for ttl seconds,
+    # then the node is read again with its ETag and indexed again when
+    # the ETag moved, so entries added by hand are picked up as well as
+    # the ones allocated here. The list is a few KB.
+    def __init__(self, firebase, cache_file=stock_cache_file, ttl=stock_cache_ttl):
+        self.firebase = firebase
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.stocks = {}
+        self.tickers = {}
+        self.etag = None
+        self.loaded = 0         # time the snapshot last changed
+        self.checked = 0        # time of the last check
+        self.load()
+
+    def load(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        with open(self.cache_file) as f:
+            cache = json.load(f)
+        self.index(cache['STOCKS'])
+        self.etag = cache.get('ETAG')
+        self.loaded = cache['LOADED']
+        self.checked = cache['CHECKED']
+
+    def save(self):
+        if not self.cache_file:
+            return
+        cache = {'STOCKS': self.stocks, 'ETAG': self.etag,
+                 'LOADED': self.loaded, 'CHECKED': self.checked}
+        save_json(self.cache_file, cache)
+
+    def index(self, stocks):
+        self.stocks = stocks
+        self.tickers = dict((ticker, stock) for stock, ticker in stocks.items())
+
+    def download(self):
+        db = self.firebase.database()
+        current = db.child(stock_list_db).get_etag()
+        now = time.time()
+        if current['ETag'] != self.etag or not self.loaded:
+            rows = current['value'] or {}
+            rows = rows.values() if isinstance(rows, dict) else [x for x in rows if x]
+            self.index(dict((x['STOCK'], x['TICKER']) for x in rows))
+            self.etag = current['ETag']
+            self.loaded = now
+        self.checked = now
+        self.save()
+
+    def revalidate(self, force=False):
+        now = time.time()
+        if force or not self.loaded or now - self.checked > self.ttl:
+            self.download()
+
+    def ticker(self, stock):
+        self.revalidate()
+        if stock not in self.stocks:
+            # maybe added by another scraper since the last check
+            self.revalidate(force=True)
+        return self.stocks.get(stock)
+
+    def stock(self, ticker):
+        self.revalidate()
+        return self.tickers.get(ticker)
+
+    def next_number(self):
+        numbers = [int(x[7:]) for x in self.tickers if x.startswith('NEWETF-') and x[7:].isdigit()]
+        return max(numbers, default=0) + 1
+
+    def allocate(self, stock):
+        # the ticker is claimed for the stock in one transaction on the
+        # meta node, so concurrent scrapers agree on it, and the entry is
+        # keyed by ticker so writing it twice is harmless
+        key = hashlib.sha1(stock.encode('utf-8')).hexdigest()
+
+        def claim(meta):
+            meta = dict(meta or {})
+            claims = dict(meta.get('CLAIMS') or {})
+            if key not in claims:
+                number = meta.get('NEXT') or self.next_number()
+                claims[key] = f'NEWETF-{number}'
+                meta['NEXT'] = number + 1
+            meta['CLAIMS'] = claims
+            return meta
+
+        db = self.firebase.database()
+        meta = transaction(db, stock_meta_db, claim)
+        ticker = meta['CLAIMS'][key]
+
+        date = str(datetime.datetime.now().date())
+        data = {'STOCK': stock, 'TICKER': ticker, 'COMMENT': f'Auto added on {date}'}
+        db.child(stock_list_db).child(ticker).set(data)
+
+        self.stocks[stock] = ticker
+        self.tickers[ticker] = stock
+        self.save()
+        return ticker
+
+
+def iter_json_items(fp, block=1 << 20):
+    # (key, value) of each member of the top level object, or (index,
+    # value) of a top level array, read from fp one block at a time
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def more():
+        nonlocal buf, pos, eof
+        data = fp.read(block)
+        eof = not data
+        buf = buf[pos:] + data
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            more()
+
+    def decode():
+        nonlocal pos
+        while True:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the buffer may be cut short
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,:]}'):
+                    pos = end
+                    return value
+            except ValueError:
+                if eof:
+                    raise
+            more()
+
+    skip(' \t\r\n')
+    if pos >= len(buf):
+        return
+    opening = buf[pos]
+    if opening not in '{[':
+        raise ValueError('expected a JSON object or array')
+    pos += 1
+
+    index = 0
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buf):
+            raise ValueError('unexpected end of JSON data')
+        if buf[pos] in '}]':
+            return
+        if opening == '{':
+            key = decode()
+            skip(' \t\r\n:')
+        else:
+            key = index
+            index += 1
+        yield key, decode()
+
+
+def page_columns(rows, tickers=None, fields=None):
+    # one page of raw_db (fields None) or daily_db records to per-ticker
+    # columns {ticker: {'DATE': datetime64[s], field: float64, ...}},
+    # values that are not numbers become NaN
+    series = {}
+    for row in rows.values():
+        date = row['DATE']
+        for ticker, value in row.get('IOPV', {}).items():
+            if tickers and ticker not in tickers:
+                continue
+            if ticker not in series:
+                series[ticker] = {'DATE': [], 'VALUES': []}
+            series[ticker]['DATE'].append(date)
+            series[ticker]['VALUES'].append(value)
+
+    columns = {}
+    for ticker, data in series.items():
+        cols = {'DATE': np.array(data['DATE'], dtype='datetime64[s]')}
+        if fields is None:
+            cols['IOPV'] = pd.to_numeric(data['VALUES'], errors='coerce').astype('float64')
+        else:
+            for field in fields:
+                values = [x.get(field) if isinstance(x, dict) else None for x in data['VALUES']]
+                cols[field] = pd.to_numeric(values, errors='coerce').astype('float64')
+        columns[ticker] = cols
+    return columns
+
+
+def in_range(key, start=None, end=None):
+    # start and end are inclusive key prefixes, so end '2024-01-02'
+    # takes in every tick of that day
+    return (not start or key >= start) and (not end or key[:len(end)] <= end)
+
+
+def page_rows(rows, tickers=None, fields=None):
+    # one page of raw_db (fields None) or daily_db records to per-ticker
+    # rows {ticker: [{'DATE', 'IOPV'}, ...]} or [{'DATE', 'OPEN', ...}]
+    stock_data = {}
+    for row in rows.values():
+        date = row['DATE']
+        for ticker, value in row.get('IOPV', {}).items():
+            if tickers and ticker not in tickers:
+                continue
+            if fields is None:
+                stock_data.setdefault(ticker, []).append({'DATE': date, 'IOPV': value})
+            else:
+                stock_data.setdefault(ticker, []).append({**value, **{'DATE': date}})
+    return stock_data
+
+
+def rows_columns(stock_data, fields=None):
+    # {ticker: [row, ...]} to {ticker: [columns]} for columns_result()
+    chunks = {}
+    for ticker, rows in stock_data.items():
+        cols = {'DATE': np.array([x['DATE'] for x in rows], dtype='datetime64[s]')}
+        for field in fields or ['IOPV']:
+            values = [x.get(field) for x in rows]
+            cols[field] = pd.to_numeric(values, errors='coerce').astype('float64')
+        chunks[ticker] = [cols]
+    return chunks
+
+
+def columns_result(chunks, result='arrays'):
+    # {ticker: [columns, ...]} to {ticker: columns} sorted by DATE
+    # ('arrays'), or to one DataFrame with a categorical TICKER column
+    # ('frame')
+    columns = {}
+    for ticker, parts in chunks.items():
+        cols = dict((k, np.concatenate([x[k] for x in parts])) for k in parts[0])
+        order = np.argsort(cols['DATE'], kind='stable')
+        columns[ticker] = dict((k, v[order]) for k, v in cols.items())
+    if result == 'arrays':
+        return columns
+
+    tickers = list(columns)
+    fields = list(columns[tickers[0]]) if tickers else ['DATE']
+    sizes = [len(columns[x]['DATE']) for x in tickers]
+    codes = np.repeat(np.arange(len(tickers)), sizes)
+    data = {'TICKER': pd.Categorical.from_codes(codes, categories=tickers)}
+    for field in fields:
+        data[field] = np.concatenate([columns[x][field] for x in tickers]) if tickers else []
+    return pd.DataFrame(data, columns=['DATE', 'TICKER'] + fields[1:])
+
+
+class FireBatch:
+    # pending writes to any number of locations, committed as
+    # multi-location PATCH requests at the database root, at most
+    # chunk_size paths per request. Use as a context manager to commit
+    # on exit, nothing is written if the block raises.
+    def __init__(self, db, chunk_size=batch_size):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.pending = {}
+        self.parents = set()    # ancestors of the pending paths
+        self.requests = 0
+
+    def set(self, path, value):
+        # a path and its ancestor cannot both be in one PATCH: a new value
+        # replaces pending writes below it, and a write below a pending
+        # value is merged into that value, a copy of the caller's
+        path = path.strip('/')
+        if isinstance(value, (dict, list)):
+            value = copy.deepcopy(value)
+        if path in self.parents:
+            prefix = path + '/'
+            for key in [x for x in self.pending if x.startswith(prefix)]:
+                del self.pending[key]
+            self.parents.discard(path)
+
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            parent = '/'.join(parts[:i])
+            if parent in self.pending:
+                node = self.pending[parent]
+                if not isinstance(node, dict):
+                    node = self.pending[parent] = {}
+                for part in parts[i:-1]:
+                    if not isinstance(node.get(part), dict):
+                        node[part] = {}
+                    node = node[part]
+                node[parts[-1]] = value
+                return
+        self.pending[path] = value
+        self.parents.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+
+    def update(self, path, data):
+        # same as db.child(path).update(data)
+        for key, value in data.items():
+            self.set(f'{path}/{key}', value)
+
+    def remove(self, path):
+        self.set(path, None)
+
+    def commit(self):
+        keys = list(self.pending)
+        for i in range(0, len(keys), self.chunk_size):
+            chunk = dict((key, self.pending[key]) for key in keys[i:i + self.chunk_size])
+            self.db.update(chunk)
+            self.requests += 1
+            for key in chunk:
+                del self.pending[key]
+        self.parents.clear()
+        return len(keys)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
 
 
 class Firework:
-    def __init__(self, config_file=firebase_config_file):
+    def __init__(self, config_file=firebase_config_file, mirror_file=None):
         self.config_file = config_file
         with open(config_file) as f:
             self.config = json.load(f)
 
         self.firebase = pyrebase.initialize_app(self.config['firebase_connect'])
-        self.load_stock_list()
+        self.ohlc = None
+        self.stocks = StockListCache(self.firebase, stock_cache_file)
+
+        # history reads served from a local copy, synced by key
+        self.mirror = None
+        if mirror_file:
+            from firemirror import FireMirror
+            self.mirror = FireMirror(self, mirror_file)
+
+    def mirrored(self, tree):
+        return self.mirror is not None and (tree != raw_db or 'market' in raw_layouts)
+
+    @property
+    def stock_list(self):
+        self.stocks.revalidate()
+        return self.stocks.stocks
 
     def load_stock_list(self):
-        self.stock_list = {}
-        db = self.firebase.database()
-        groups = db.child('stock-list').get()
-        for row in groups.each():
-            data = row.val()
-            self.stock_list[data['STOCK']] = data['TICKER']
+        self.stocks.revalidate(force=True)
 
     def get_stock_ticker(self, stock):
-        if stock not in self.stock_list:
-            self.add_stock(stock)
-            self.load_stock_list()
-        return self.stock_list[stock]
+        ticker = self.stocks.ticker(stock)
+        if ticker is None:
+            ticker = self.add_stock(stock)
+        return ticker
+
+    def get_stock_name(self, ticker):
+        return self.stocks.stock(ticker)
 
     def add_stock(self, stock):
-        # find the next available ETF ticker
-        for i in range(1000):
-            ticker = 'NEWETF-' + str(i + 1)
-            if ticker not in self.stock_list:
-                break
-        else:
-            raise KeyError(f'[ERROR] unable to create a ticker for new ETF: {stock}')
+        # next NEWETF-<n> ticker from the shared counter
+        return self.stocks.allocate(stock)
 
-        date = str(datetime.datetime.now().date())
-        data = {'STOCK': stock, 'TICKER': ticker, 'COMMENT': f'Auto added on {date}'}
-        db = self.firebase.database()
-        db.child('stock-list').push(data)
+    def resolve_ticker(self, stock):
+        return self.get_stock_ticker(stock)
 
-    def get_stock_daily(self, tickers, last=100):
-        db = self.firebase.database()
+    def iter_pages(self, path, page=stream_page, start_key=None, inclusive=False):
+        # the children of path in key order, page records at a time,
+        # starting after start_key, or at it when inclusive
+        while True:
+            db = self.firebase.database()
+            query = db.child(path).order_by_key()
+            if start_key:
+                query = query.start_at(start_key)
+            skip = start_key if start_key and not inclusive else None
+            rows = query.limit_to_first(page + 1 if skip else page).get().val()
+            rows = dict((k, v) for k, v in (rows or {}).items() if k != skip)
+            inclusive = False
+            if not rows:
+                return
+            yield rows
+            start_key = list(rows)[-1]
+
+    def read_pages(self, path, last):
+        # the last records by DATE in one response, or every record a
+        # page at a time when last < 0
         if last < 0:
-            data = db.child(daily_db).get()
-        else:
-            data = db.child(daily_db).order_by_child('DATE').limit_to_last(last).get()
+            yield from self.iter_pages(path)
+            return
+        db = self.firebase.database()
+        yield db.child(path).order_by_child('DATE').limit_to_last(last).get().val() or {}
+
+    def iter_stock_raw(self, tickers=None, page=stream_page):
+        # full raw history as (ticker, columns) chunks, one page of
+        # snapshots in memory at a time
+        tickers = set(tickers) if tickers else None
+        for rows in self.iter_pages(raw_db, page):
+            yield from page_columns(rows, tickers).items()
+
+    def iter_stock_daily(self, tickers=None, page=stream_page):
+        tickers = set(tickers) if tickers else None
+        for rows in self.iter_pages(daily_db, page):
+            yield from page_columns(rows, tickers, ohlc_fields).items()
+
+    def read_columns(self, path, tickers, last, fields=None):
+        tickers = set(tickers) if tickers else None
+        chunks = {}
+        for rows in self.read_pages(path, last):
+            for ticker, cols in page_columns(rows, tickers, fields).items():
+                chunks.setdefault(ticker, []).append(cols)
+        return chunks
+
+    def get_stock_daily(self, tickers, last=100, result='rows'):
+        # result 'rows' gives {ticker: [{DATE, OPEN, ...}, ...]}, 'arrays'
+        # {ticker: {DATE: datetime64[], OPEN: float64[], ...}} and 'frame'
+        # one DataFrame with a categorical TICKER column
+        if self.mirrored(daily_db):
+            return self.mirror.get_stock_daily(tickers, last, result)
+        if result != 'rows':
+            return columns_result(self.read_columns(daily_db, tickers, last, ohlc_fields), result)
 
         stock_data = {}
-        rows = data.val()
-        for row in rows.values():
-            date = row['DATE']
-            iset = row['IOPV']
-            for ticker, iopv in iset.items():
-                if tickers and ticker not in tickers:
-                    continue
-                if ticker not in stock_data:
-                    stock_data[ticker] = []
-                stock_data[ticker].append({**iopv, **{'DATE': date}})
+        for rows in self.read_pages(daily_db, last):
+            for ticker, data in page_rows(rows, tickers, ohlc_fields).items():
+                stock_data.setdefault(ticker, []).extend(data)
 
         return stock_data
 
-    def get_stock_raw(self, tickers, last=100):
-        db = self.firebase.database()
-        if last < 0:
-            data = db.child(raw_db).get()
-        else:
-            data = db.child(raw_db).order_by_child('DATE').limit_to_last(last).get()
+    def get_stock_raw(self, tickers, last=100, result='rows'):
+        if self.mirrored(raw_db):
+            return self.mirror.get_stock_raw(tickers, last, result)
+        if result != 'rows':
+            return columns_result(self.read_columns(raw_db, tickers, last), result)
 
         stock_data = {}
-        rows = data.val()
-        for row in rows.values():
-            date = row['DATE']
-            iset = row['IOPV']
-            for ticker, iopv in iset.items():
-                if tickers and ticker not in tickers:
-                    continue
-                if ticker not in stock_data:
-                    stock_data[ticker] = []
-                stock_data[ticker].append({'DATE': date, 'IOPV': iopv})
+        for rows in self.read_pages(raw_db, last):
+            for ticker, data in page_rows(rows, tickers).items():
+                stock_data.setdefault(ticker, []).extend(data)
 
         return stock_data
 
-    def update_stock_raw(self, date, data):
+    def get_ticker_raw(self, tickers, days=shard_days, last=-1, packed=None, result='rows'):
+        # same result as get_stock_raw(), read from the per-ticker layout,
+        # one small query per ticker instead of whole-market snapshots.
+        # The packed layout is read when it is the one being written, or
+        # when asked for; it has one row per run of unchanged prices.
+        if packed is None:
+            packed = 'packed' in raw_layouts and 'ticker' not in raw_layouts
+        if self.mirrored(raw_db):
+            return self.mirror.get_ticker_raw(tickers, days, last, result)
+
+        def read(ticker):
+            rows = self.ticker_rows(ticker, packed, days=days)
+            return rows[-last:] if last > 0 else rows
+
+        stock_data = self.read_tickers(read, tickers)
+        if result == 'rows':
+            return stock_data
+        return columns_result(rows_columns(stock_data), result)
+
+    def read_tickers(self, read, tickers):
+        # {ticker: read(ticker)} for the tickers with rows, a few at a time
+        tickers = list(tickers)
+        with ThreadPoolExecutor(max_workers=shard_workers) as pool:
+            results = pool.map(read, tickers)
+            return dict((ticker, rows) for ticker, rows in zip(tickers, results) if rows)
+
+    def ticker_rows(self, ticker, packed, start=None, end=None, days=None):
+        # one ticker's ticks from the per-ticker or packed layout, of the
+        # days from start to end (inclusive), or of its last days
+        db = self.firebase.database()
+        node = packed_db if packed else shard_db
+        query = db.child(node).child(ticker).order_by_key()
+        if start:
+            query = query.start_at(start[:10])
+        if end:
+            query = query.end_at(end[:10])
+        if days:
+            query = query.limit_to_last(days)
+        rows = []
+        for day, ticks in (query.get().val() or {}).items():
+            if packed:
+                rows.extend(unpack_day(day, ticks))
+            else:
+                rows.extend({'DATE': f'{day} {tm}', 'IOPV': iopv} for tm, iopv in ticks.items())
+        rows = [x for x in rows if in_range(x['DATE'], start, end)]
+        rows.sort(key=lambda x: x['DATE'])
+        return rows
+
+    def iter_range(self, path, start=None, end=None, page=stream_page):
+        # the records of path keyed from start to end (inclusive), a page
+        # at a time
+        for rows in self.iter_pages(path, page, start, inclusive=True):
+            last = list(rows)[-1]
+            rows = dict((k, v) for k, v in rows.items() if in_range(k, start, end))
+            if rows:
+                yield rows
+            if not in_range(last, start, end):
+                return
+
+    def read_range(self, tickers, start=None, end=None, daily=False, result='rows'):
+        # ticks (or daily bars) of the tickers from start to end, both
+        # inclusive key prefixes such as '2024-01-02' or '2024-01-02 09:30',
+        # in the same results as get_stock_raw() and get_stock_daily()
+        fields = ohlc_fields if daily else None
+        tree = daily_db if daily else raw_db
+        if self.mirrored(tree):
+            return self.mirror.read_range(tickers, start, end, daily, result)
+
+        if daily or 'market' in raw_layouts:
+            tickers = set(tickers) if tickers else None
+            chunks = {}
+            for rows in self.iter_range(tree, start, end):
+                page = page_rows(rows, tickers, fields) if result == 'rows' else \
+                    dict((k, [v]) for k, v in page_columns(rows, tickers, fields).items())
+                for ticker, data in page.items():
+                    chunks.setdefault(ticker, []).extend(data)
+            return chunks if result == 'rows' else columns_result(chunks, result)
+
+        packed = 'ticker' not in raw_layouts
+        if not tickers:
+            tickers = self.layout_tickers(packed_db if packed else shard_db)
+        stock_data = self.read_tickers(lambda x: self.ticker_rows(x, packed, start, end), tickers)
+        if result == 'rows':
+            return stock_data
+        return columns_result(rows_columns(stock_data), result)
+
+    def layout_tickers(self, node):
+        # the tickers of a per-ticker layout, keys only, so tickers that
+        # left the stock list are there too
+        db = self.firebase.database()
+        return list(db.child(node).shallow().get().val() or [])
+
+    def update_ticker_raw(self, timestamp, iopv_dict, batch=None):
+        day, tm = timestamp.split(' ')
+        data = dict((f'{ticker}/{day}/{tm}', iopv) for ticker, iopv in iopv_dict.items())
+        if batch is not None:
+            batch.update(shard_db, data)
+            return
+        db = self.firebase.database()
+        db.child(shard_db).update(data)
+
+    def update_packed_raw(self, timestamp, runs, batch=None):
+        # runs = {ticker: (index, iopv)}, index of a new run or None when
+        # the price is unchanged and only END moves
+        day, tm = timestamp.split(' ')
+        hh, mm, ss = [int(x) for x in tm.split(':')]
+        sec = hh * 3600 + mm * 60 + ss
+        data = {}
+        for ticker, (index, iopv) in runs.items():
+            if index is not None:
+                data[f'{ticker}/{day}/T/{index}'] = sec
+                data[f'{ticker}/{day}/V/{index}'] = iopv
+            data[f'{ticker}/{day}/END'] = sec
+        if batch is not None:
+            batch.update(packed_db, data)
+            return
+        db = self.firebase.database()
+        db.child(packed_db).update(data)
+
+    def migrate_raw(self, start_key=None, page=200, chunk_size=batch_size):
+        # copy raw_db snapshots into the per-ticker layout, page by page
+        # in key order; rerun with the last key printed to resume
+        count = 0
+        for rows in self.iter_pages(raw_db, page, start_key):
+            with self.batch(chunk_size) as batch:
+                for row in rows.values():
+                    self.update_ticker_raw(row['DATE'], row.get('IOPV', {}), batch)
+            count += len(rows)
+            print(f'{count} snapshots migrated, last key {list(rows)[-1]}')
+
+        return count
+
+    def batch(self, chunk_size=batch_size):
+        return FireBatch(self.firebase.database(), chunk_size)
+
+    def update_stock_raw(self, date, data, batch=None):
+        if batch is not None:
+            batch.update(f'{raw_db}/{date}', data)
+            return
         db = self.firebase.database()
         db.child(raw_db).child(date).update(data)
 
-    def update_stock_daily(self, date, data):
+    def update_stock_daily(self, date, data, batch=None):
+        if batch is not None:
+            batch.update(f'{daily_db}/{date}', data)
+            return
         db = self.firebase.database()
         db.child(daily_db).child(date).update(data)
 
-    def update_iopv_list(self, iopv_list, logtime=None):
+    def rebuild_ohlc(self, date):
+        # cold start: replay today's raw ticks into a fresh accumulator
+        if self.mirrored(raw_db):
+            rows = self.mirror.get_day_raw(date)
+        elif 'market' not in raw_layouts:
+            # every ticker written today, listed or not
+            stock_data = self.read_range(None, date, date)
+            rows = [(x['DATE'], stk, x['IOPV']) for stk, ticks in stock_data.items() for x in ticks]
+        else:
+            db = self.firebase.database()
+            raw = db.child(raw_db).order_by_child('DATE').start_at(date).get()
+            raw_data = raw.val()
+            if not raw_data:
+                raw_data = {}
+            rows = [(dt, stk, iopv) for dt, row in raw_data.items() if date in dt
+                    for stk, iopv in row.get('IOPV', {}).items()]
+
+        self.ohlc.replay(date, rows)
+
+    def update_iopv_list(self, iopv_list, logtime=None, batch=None):
         # build dates
         if logtime:
             now = logtime
@@ -131,110 +824,228 @@ class Firework:
         date = str(now.date())
         timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        # download all data
-        db = self.firebase.database()
-        raw = db.child(raw_db).order_by_child('DATE').start_at(date).get()
-        raw_data = raw.val()
-        if not raw_data:
-            raw_data = {}
+        # today's running OHLC, from the local state file when possible
+        if not self.ohlc:
+            self.ohlc = OhlcAccumulator(ohlc_state_file)
+        cold_start = self.ohlc.date != date
+        if cold_start:
+            self.rebuild_ohlc(date)
 
-        # update IOPV raw database
+        # raw and daily writes go out together in one PATCH, or with the
+        # rest of the caller's batch
+        commit = batch is None
+        if commit:
+            batch = self.batch()
         iopv_dict = {}
         for stock, iopv in iopv_list:
             ticker = self.get_stock_ticker(stock)
             iopv_dict[ticker] = iopv
-        fire_data = {"DATE": timestamp, "IOPV": iopv_dict}
-        db.child(raw_db).child(timestamp).update(fire_data)
-
-        # update IOPV daily database
-        raw_data[timestamp] = fire_data     # add new data to pool
-        stock_iopv = {}
-        for dt, iset in raw_data.items():
-            if date not in dt:
-                continue
-            for stk, iopv in iset['IOPV'].items():
-                if stk not in stock_iopv:
-                    stock_iopv[stk] = []
-                stock_iopv[stk].append({'DATE': dt, 'IOPV': iopv})
-
-        daily_dict = {}
-        for stk, ilist in stock_iopv.items():
-            ilist.append({'DATE': timestamp, 'IOPV': iopv_dict[stk]})
-            op, hi, lo, cl = get_ohlc(ilist)
-            ohlc = {'OPEN': op, 'HIGH': hi, 'LOW': lo, 'CLOSE': cl}
-            daily_dict[stk] = ohlc
-
-        fire_data = {"DATE": date, "IOPV": daily_dict}
-        db.child(daily_db).child(date).update(fire_data)
-
-    def import_json(self, db_path, filename):
+        self.append_ticks(timestamp, iopv_dict, batch)
+
+        # update IOPV daily database, all tickers after a cold start,
+        # else only the ones in this tick
+        runs = {}
+        for ticker, iopv in iopv_dict.items():
+            if self.ohlc.add(ticker, timestamp, iopv):
+                runs[ticker] = (self.ohlc.bars[ticker]['RUNS'] - 1, iopv)
+            elif self.ohlc.bars.get(ticker, {}).get('LAST') == timestamp:
+                runs[ticker] = (None, iopv)
+        if 'packed' in raw_layouts:
+            self.update_packed_raw(timestamp, runs, batch)
+        if cold_start:
+            fire_data = {"DATE": date, "IOPV": self.ohlc.daily()}
+        else:
+            fire_data = dict((f'IOPV/{ticker}', self.ohlc.ohlc(ticker))
+                             for ticker in iopv_dict if ticker in self.ohlc.bars)
+            fire_data['DATE'] = date
+        self.update_stock_daily(date, fire_data, batch)
+        # with the caller's batch, the caller saves the state once the
+        # batch is committed
+        if commit:
+            batch.commit()
+            self.ohlc.save()
+
+    def append_ticks(self, timestamp, ticks, batch=None):
+        # ticks = {ticker: iopv} to the market and per-ticker layouts; the
+        # packed layout needs the running OHLC, see update_iopv_list()
+        if 'market' in raw_layouts:
+            self.update_stock_raw(timestamp, {"DATE": timestamp, "IOPV": ticks}, batch)
+        if 'ticker' in raw_layouts:
+            self.update_ticker_raw(timestamp, ticks, batch)
+
+    def upsert_daily(self, date, bars, batch=None):
+        # bars = {ticker: {OPEN, HIGH, LOW, CLOSE}}, other tickers' bars
+        # of the day are kept
+        data = dict((f'IOPV/{ticker}', bar) for ticker, bar in bars.items())
+        data['DATE'] = date
+        self.update_stock_daily(date, data, batch)
+
+    def log(self, logtime, msg):
+        timestamp = logtime.strftime("%Y-%m-%d %H:%M:%S")
+        db = self.firebase.database()
+        db.child(log_db).push({'DATE': timestamp, 'MSG': str(msg)})
+
+    def heartbeat(self, changed, logtime=None, batch=None):
+        # cheap proof of life for ticks that wrote little or nothing
+        now = logtime if logtime else datetime.datetime.now()
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        if batch is not None:
+            batch.set(heartbeat_db, {'DATE': timestamp, 'CHANGED': changed})
+            return
         db = self.firebase.database()
-        with open(filename) as f:
-            data = json.load(f)
-            db.child(db_path).set(data)
-
-    def import_csv(self, db_path, filename, delim='\t'):
-        with open(filename) as f:
-            reader = csv.DictReader(f, delimiter=delim)
-            data = []
-            for row in reader:
-                try:
-                    date = to_datetime(row['DATE'], format='%d/%m/%Y')
-                    row['DATE'] = str(date.date())
-                except KeyError:
-                    pass
-                try:
-                    time = to_datetime(row['TIME'], format='%d/%m/%Y %H:%M:%S')
-                    row['DATE'] = str(time)
-                    del row['TIME']
-                except KeyError:
-                    pass
-                data.append(dict(row))
+        db.child(heartbeat_db).set({'DATE': timestamp, 'CHANGED': changed})
+
+    def upload_chunk(self, chunk):
+        # one multi-location PATCH, retried with backoff
+        for attempt in range(import_retries):
+            try:
+                self.firebase.database().update(chunk)
+                return len(chunk)
+            except Exception as err:
+                if attempt == import_retries - 1:
+                    raise
+                wait = 2 ** attempt
+                print(f'upload failed ({err!r}), retry in {wait}s')
+                time.sleep(wait)
+
+    def upload_chunks(self, chunks, replace_path=None):
+        # upload the {path: value} chunks of chunks() in parallel, at most
+        # two chunks per worker in memory, and report the rate. Before
+        # replace_path is removed the chunks are read through once without
+        # uploading, so a file that fails to parse leaves it as it was.
+        if replace_path:
+            rows = sum(len(x) for x in chunks())
+            print(f'{rows} rows parsed, replacing {replace_path}')
+            self.firebase.database().child(replace_path).remove()
+
+        count = 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=import_workers) as pool:
+            running = []
+            for chunk in chunks():
+                running.append(pool.submit(self.upload_chunk, chunk))
+                if len(running) >= import_workers * 2:
+                    count += running.pop(0).result()
+                    rate = count / max(time.time() - start, 1e-3)
+                    print(f'{count} rows imported ({rate:.0f} rows/s)')
+            for future in running:
+                count += future.result()
+
+        elapsed = max(time.time() - start, 1e-3)
+        print(f'{count} rows imported in {elapsed:.1f}s ({count / elapsed:.0f} rows/s)')
+        return count
+
+    def import_json(self, db_path, filename, replace=True):
+        # the top level members of the file become the children of
+        # db_path, uploaded in chunks as the file is read
+        def chunks():
+            with open(filename) as f:
+                chunk = {}
+                for key, value in iter_json_items(f):
+                    chunk[f'{db_path}/{key}'] = value
+                    if len(chunk) >= import_rows:
+                        yield chunk
+                        chunk = {}
+                if chunk:
+                    yield chunk
+
+        return self.upload_chunks(chunks, db_path if replace else None)
+
+    def import_csv(self, db_path, filename, delim='\t', replace=True):
+        # rows become db_path/0, db_path/1, ..., the same as setting the
+        # list of rows; DATE (dd/mm/yyyy) and TIME (dd/mm/yyyy HH:MM:SS)
+        # are converted one chunk at a time
+        def chunks():
+            reader = pd.read_csv(filename, sep=delim, dtype=str, keep_default_na=False,
+                                 chunksize=import_rows)
+            offset = 0
+            for df in reader:
+                if 'DATE' in df.columns:
+                    date = to_datetime(df['DATE'], format='%d/%m/%Y')
+                    df['DATE'] = date.dt.strftime('%Y-%m-%d')
+                if 'TIME' in df.columns:
+                    time = to_datetime(df['TIME'], format='%d/%m/%Y %H:%M:%S')
+                    df['DATE'] = time.dt.strftime('%Y-%m-%d %H:%M:%S')
+                    df = df.drop(columns='TIME')
+                rows = df.to_dict('records')
+                yield dict((f'{db_path}/{offset + i}', row) for i, row in enumerate(rows))
+                offset += len(rows)
+
+        return self.upload_chunks(chunks, db_path if replace else None)
+
+    def purge(self, path, end_key, fp, page=purge_page, chunk_size=batch_size):
+        # back up and remove every child of path with a key up to end_key,
+        # one page at a time. A page is written to the backup before it
+        # is removed, so an interrupted purge is resumed by running it
+        # again, at worst one page is backed up twice.
+        count = 0
+        start = time.time()
+        while True:
             db = self.firebase.database()
-            db.child(db_path).set(data)
+            rows = db.child(path).order_by_key().end_at(end_key).limit_to_first(page).get().val()
+            if not rows:
+                break
+
+            for key, value in rows.items():
+                fp.write(json.dumps({'PATH': f'{path}/{key}', 'DATA': value}) + '\n')
+            fp.flush()
+            with self.batch(chunk_size) as batch:
+                for key in rows:
+                    batch.remove(f'{path}/{key}')
+
+            count += len(rows)
+            rate = count / max(time.time() - start, 1e-3)
+            print(f'{path}: {count} purged up to {key} ({rate:.0f}/s)')
+
+        return count
+
+    def open_backup(self, save_to):
+        # gzip JSON lines, one {PATH, DATA} record per line; a rerun after
+        # an interrupted purge gets a new file next to the old one
+        base = save_to[:-len('.jsonl.gz')] if save_to.endswith('.jsonl.gz') else save_to
+        n = 1
+        while os.path.exists(save_to):
+            save_to = f'{base}-{n}.jsonl.gz'
+            n += 1
+        return save_to, gzip.open(save_to, 'wt')
 
     def purge_daily(self, keep_days=300, save_to=None):
         today = datetime.date.today()
         end_date = today - datetime.timedelta(keep_days)
-        db = self.firebase.database()
-        data = db.child(daily_db).order_by_child('DATE').end_at(str(end_date)).get()
+        if not save_to:
+            save_to = f'iopv-daily-purged-{today}.jsonl.gz'
 
-        if not data.each():
-            print(f'no daily data to purse')
+        save_to, fp = self.open_backup(save_to)
+        with fp:
+            count = self.purge(daily_db, str(end_date), fp)
+        if not count:
+            os.remove(save_to)
+            print(f'no daily data to purge')
             return
-
-        # backup the data before removing from database
-        if not save_to:
-            save_to = f'iopv-daily-purged-{today}.json'
-        with open(save_to, 'w') as fp:
-            json.dump(data.val(), fp, indent=2)
         print(f'purged daily data saved to {save_to}')
 
-        for rec in data.each():
-            key = rec.key()
-            db.child(daily_db).child(key).remove()
-
     def purge_raw(self, keep_days=7, save_to=None):
         today = datetime.date.today()
         end_date = today - datetime.timedelta(keep_days)
-        db = self.firebase.database()
-        data = db.child(raw_db).order_by_child('DATE').end_at(str(end_date)).get()
+        if not save_to:
+            save_to = f'iopv-raw-purged-{today}.jsonl.gz'
 
-        if not data.each():
-            print(f'no raw data to purse')
+        # raw_db keys are timestamps, the per-ticker layouts are keyed by
+        # day, both stop before end_date
+        end_day = str(end_date - datetime.timedelta(1))
+        save_to, fp = self.open_backup(save_to)
+        with fp:
+            count = self.purge(raw_db, str(end_date), fp)
+            for layout, node in (('ticker', shard_db), ('packed', packed_db)):
+                if layout in raw_layouts:
+                    for ticker in self.layout_tickers(node):
+                        count += self.purge(f'{node}/{ticker}', end_day, fp)
+        if not count:
+            os.remove(save_to)
+            print(f'no raw data to purge')
             return
-
-        # backup the data before removing from database
-        if not save_to:
-            save_to = f'iopv-raw-purged-{today}.json'
-        with open(save_to, 'w') as fp:
-            json.dump(data.val(), fp, indent=2)
         print(f'purged raw data saved to {save_to}')
 
-        for rec in data.each():
-            key = rec.key()
-            db.child(raw_db).child(key).remove()
-
     def upload_file(self, path, remote=None):
         if not remote:
             remote_path = path
@@ -255,7 +1066,7 @@ class Firework:
 if __name__ == "__main__":
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv, 'i:')
+        opts, args = getopt.getopt(argv, 'i:k:M')
         Options = dict(opts)
         if '-i' in Options.keys():
             a = Options['-i']
@@ -264,6 +1075,10 @@ if __name__ == "__main__":
         sys.exit(2)
 
     fire = Firework()
+    if '-M' in Options.keys():
+        fire.migrate_raw(start_key=Options.get('-k'))
+        sys.exit(0)
+
     price = fire.get_stock_daily(['0829EA'], last=3)
     pprint(price)
     price = fire.get_stock_raw(['0829EA'], last=3)
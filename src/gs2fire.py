@@ -2,8 +2,8 @@ import sys
 import json
 import getopt
 import datetime
-from fireworks import Firework
 from gspreaddb import GspreadDB
+from iopvstore import open_store
 from utils import getstocklist
 from pandas import to_datetime
 
@@ -11,7 +11,7 @@ DailyDbName = 'iopvdb-daily'
 SourceDbName = 'iopvdb2'
 JsonAuthFile = 'iopv.json'
 DebugMode = True
-update_fire = False
+StoreSpec = None        # stores to copy to, comma separated, see open_store()
 LastDaysRaw = 7
 
 def main(stocks):
@@ -54,37 +54,41 @@ def main(stocks):
             print(f"error getting sheet data for '{stock}': {ve}")
             continue
 
+    print(f'Sheets: {stockdb.scheduler.report()}')
     print(f'Writing JSON files...')
     with open('iopv-raw.json', 'w') as fp:
         json.dump(iopv_by_date, fp, sort_keys=True, indent=4)
     with open('iopv-daily.json', 'w') as fp:
         json.dump(daily_by_date, fp, sort_keys=True, indent=4)
 
-    if update_fire:
-        fire = Firework()
+    for spec in StoreSpec.split(',') if StoreSpec else []:
+        store = open_store(spec)
+        batch = store.batch()
 
-        # update raw database
-        print(f'Updating Firebase raw database...')
+        # both databases go out together in a few large PATCH requests,
+        # or one transaction on a local store
+        print(f'Updating {spec} raw and daily databases...')
         for date, rec in iopv_by_date.items():
-            fire.update_stock_raw(date, rec)
-
-        # update daily database
-        print(f'Updating Firebase daily database...')
+            store.append_ticks(date, rec['IOPV'], batch)
         for date, rec in daily_by_date.items():
-            fire.update_stock_daily(date, rec)
+            store.upsert_daily(date, rec['IOPV'], batch)
+        paths = batch.commit()
+        print(f'{paths} paths written in {batch.requests} requests')
 
 
 if __name__ == "__main__":
     argv = sys.argv[1:]
     stocklist = []
     try:
-        opts, args = getopt.getopt(argv, 'r:FL:')
+        opts, args = getopt.getopt(argv, 'r:FL:S:')
         Options = dict(opts)
         if '-L' in Options.keys():
             listfile = Options['-L']
             stocklist = getstocklist(listfile)
         if '-F' in Options.keys():
-            update_fire = True
+            StoreSpec = 'firebase'
+        if '-S' in Options.keys():
+            StoreSpec = Options['-S']
         if '-r' in Options.keys():
             LastDaysRaw = Options['-r']
     except getopt.GetoptError:
@@ -1,6 +1,319 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import atexit
+import random
+import threading
 import gspread
+import requests
+from datetime import datetime
 from oauth2client.service_account import ServiceAccountCredentials
-from gspread.exceptions import WorksheetNotFound
+from gspread.exceptions import WorksheetNotFound, APIError
+from gspread.utils import absolute_range_name
+from urllib3.exceptions import NewConnectionError
+
+ReadQuota = 60          # Sheets API requests a minute per user, the default
+WriteQuota = 60
+QuotaBurst = 10         # requests that can go out back to back
+QuotaFile = 'gspread-quota.json'    # buckets shared by the scripts, kept next to
+                                    # the credentials file; None per process
+Retries = 6             # attempts of a request on 429, and of a read on 5xx
+BaseBackoff = 1         # seconds, doubled on every retry
+MaxBackoff = 64
+MaxQueued = 200         # queued write requests per workbook before a flush
+SheetRecheck = 600      # seconds before a missing sheet is looked for again
+SerialEpoch = datetime(1899, 12, 30)    # day 0 of Sheets date serial numbers
+
+
+class TokenBucket:
+    # rate tokens a second, at most burst of them saved up. With a state
+    # file the bucket is shared, under a lock, by all the processes that
+    # use the same file.
+    def __init__(self, name, rate, burst, state_file=None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.state_file = state_file
+        self.state = [burst, time.time()]
+        self.lock = threading.Lock()
+
+    def refill(self, state):
+        # a token when there is one, else the seconds until there is
+        now = time.time()
+        tokens, stamp = state
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+        if tokens >= 1:
+            return [tokens - 1, now], 0
+        return [tokens, now], (1 - tokens) / self.rate
+
+    def try_take(self):
+        with self.lock:
+            if not self.state_file:
+                self.state, wait = self.refill(self.state)
+                return wait
+            with open(self.state_file, 'a+') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                try:
+                    states = json.loads(f.read() or '{}')
+                except ValueError:
+                    states = {}
+                states[self.name], wait = self.refill(states.get(self.name, self.state))
+                f.seek(0)
+                f.truncate()
+                json.dump(states, f)
+            return wait
+
+    def take(self):
+        # waits for a token, returns the seconds waited
+        waited = 0
+        while True:
+            wait = self.try_take()
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+def rejected(err):
+    # a client error that sending again will not fix
+    return isinstance(err, APIError) and 400 <= err.response.status_code < 500 \
+        and err.response.status_code != 429
+
+
+def unsent(err):
+    # the request was turned away before the API acted on it: a 429, or
+    # no connection made. A 5xx or a connection lost after sending may
+    # have left the write done.
+    if isinstance(err, APIError):
+        return err.response.status_code == 429
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(err, requests.exceptions.ConnectionError) and err.args:
+        return isinstance(getattr(err.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def same_time(cell, time):
+    # a time pasted as "%d/%m/%Y %H:%M:%S" and read back unformatted, as
+    # a serial number of days or as text when it was not parsed
+    if isinstance(cell, (int, float)):
+        try:
+            delta = datetime.strptime(time, "%d/%m/%Y %H:%M:%S") - SerialEpoch
+        except ValueError:
+            return False
+        return abs(cell - delta.total_seconds() / 86400) < 1e-6
+    return str(cell) == time
+
+
+def sheet_of(request):
+    # sheetId of an insertDimension or pasteData request
+    body = next(iter(request.values()))
+    return (body.get('range') or body.get('coordinate') or {}).get('sheetId')
+
+
+class RequestScheduler:
+    # every Sheets API request of the process goes through request():
+    # reads and writes are metered by their own token bucket, 429 replies
+    # are retried with jittered exponential backoff, and so are 5xx and
+    # dropped connections of reads; a write is only sent again when it
+    # cannot have been applied. Writes queued with queue() are merged
+    # into one batch update per workbook, sent when the queue is long,
+    # before the next request that reads the workbook, on flush() and at
+    # exit.
+    def __init__(self, read_quota=ReadQuota, write_quota=WriteQuota, burst=QuotaBurst,
+                 state_file=None, retries=Retries):
+        self.buckets = {'read': TokenBucket('read', read_quota / 60, burst, state_file),
+                        'write': TokenBucket('write', write_quota / 60, burst, state_file)}
+        self.retries = retries
+        self.pending = {}       # workbook id: (workbook, [write, ...])
+        self.flushing = set()   # workbook ids being sent
+        self.lock = threading.RLock()
+        self.requests = 0
+        self.retried = 0
+        self.rejected = 0       # queued requests dropped on a 4xx
+        self.throttled = 0      # seconds waited for a token
+        self.backoff = 0        # seconds waited after errors
+        atexit.register(self.close)
+
+    def install(self, client):
+        # route a gspread client's requests through request(), from the
+        # http_client of gspread 6 or the client itself before that
+        target = getattr(client, 'http_client', client)
+        send = target.request
+        target.request = lambda method, endpoint, *args, **kwargs: \
+            self.request(send, method, endpoint, *args, **kwargs)
+        return client
+
+    def request(self, send, method, endpoint, *args, **kwargs):
+        kind = 'read' if method.upper() == 'GET' else 'write'
+        if kind == 'read':
+            # read your own writes
+            for key in [x for x in self.pending if x in endpoint and x not in self.flushing]:
+                self.flush(key)
+
+        for attempt in range(self.retries):
+            self.throttled += self.buckets[kind].take()
+            self.requests += 1
+            try:
+                return send(method, endpoint, *args, **kwargs)
+            except APIError as err:
+                status = err.response.status_code
+                if not (status == 429 or status >= 500 and kind == 'read') \
+                        or attempt == self.retries - 1:
+                    raise
+            except requests.exceptions.ConnectionError as err:
+                if not (kind == 'read' or unsent(err)) or attempt == self.retries - 1:
+                    raise
+            wait = random.uniform(0, min(MaxBackoff, BaseBackoff * 2 ** attempt))
+            self.retried += 1
+            self.backoff += wait
+            time.sleep(wait)
+
+    def queue(self, workbook, batch, redo=None):
+        # batch is the requests of one sheet's write, kept together. If a
+        # send fails in a way that may have applied them, redo() is called
+        # before they go out again and returns the requests still needed;
+        # writes without one are dropped then.
+        with self.lock:
+            if batch:
+                write = {'requests': list(batch), 'redo': redo, 'stale': False}
+                self.pending.setdefault(workbook.id, (workbook, []))[1].append(write)
+            if self.depth(workbook.id) >= MaxQueued:
+                self.flush(workbook.id)
+
+    def flush(self, key=None):
+        # send the queued writes, of one workbook or of all of them. They
+        # stay queued until sent, so a failed flush is tried again later
+        with self.lock:
+            for key in [key] if key else list(self.pending):
+                if key in self.pending and key not in self.flushing:
+                    self.flushing.add(key)
+                    try:
+                        self.flush_workbook(key)
+                    finally:
+                        self.flushing.discard(key)
+
+    def flush_workbook(self, key):
+        workbook, queued = self.pending[key]
+        self.recheck(key, [x for x in queued if x['stale']])
+        writes = list(self.pending.get(key, (None, []))[1])
+        if not writes:
+            return
+        try:
+            self.send(workbook, writes)
+        except Exception as err:
+            if not rejected(err):
+                self.failed(key, writes, err)
+                raise
+            # one bad request fails the whole batch update, the sheets
+            # are sent one by one to keep the writes of the others
+            self.flush_sheets(key, workbook, writes)
+            return
+        self.unqueue(key, writes)
+
+    def flush_sheets(self, key, workbook, writes):
+        sheets = {}
+        for write in writes:
+            sheets.setdefault(sheet_of(write['requests'][0]), []).append(write)
+        for sheet, sheet_writes in sheets.items():
+            try:
+                self.send(workbook, sheet_writes)
+            except Exception as err:
+                if not rejected(err):
+                    self.failed(key, sheet_writes, err)
+                    raise
+                count = sum(len(x['requests']) for x in sheet_writes)
+                self.rejected += count
+                print(f'Sheets: {count} requests to sheet {sheet} rejected ({err!r})',
+                      file=sys.stderr)
+            self.unqueue(key, sheet_writes)
+
+    def failed(self, key, writes, err):
+        # after a send that may have been applied the writes are not sent
+        # as they are: they are redone first, or dropped
+        if unsent(err):
+            return
+        lost = [x for x in writes if x['redo'] is None]
+        for write in writes:
+            write['stale'] = True
+        if lost:
+            print(f"Sheets: {sum(len(x['requests']) for x in lost)} requests dropped, "
+                  f"maybe written ({err!r})", file=sys.stderr)
+            self.unqueue(key, lost)
+
+    def recheck(self, key, writes):
+        for write in writes:
+            write['requests'] = list(write['redo']())
+            write['stale'] = False
+        self.unqueue(key, [x for x in writes if not x['requests']])
+
+    def send(self, workbook, writes):
+        workbook.batch_update({'requests': [x for write in writes for x in write['requests']]})
+
+    def unqueue(self, key, writes):
+        # drop writes that are done with, keeping any queued meanwhile
+        done = set(id(x) for x in writes)
+        workbook, queued = self.pending.get(key, (None, []))
+        queued[:] = [x for x in queued if id(x) not in done]
+        if not queued:
+            self.pending.pop(key, None)
+
+    def close(self):
+        try:
+            self.flush()
+        except Exception as err:
+            print(f'Sheets: {self.depth()} queued requests lost ({err!r})', file=sys.stderr)
+
+    def depth(self, key=None):
+        # queued requests, of one workbook or of all of them
+        workbooks = [self.pending.get(key, (None, []))] if key else self.pending.values()
+        return sum(len(x['requests']) for workbook, queued in workbooks for x in queued)
+
+    def report(self):
+        return (f'{self.requests} requests, {self.retried} retried, {self.rejected} rejected, '
+                f'{self.depth()} queued, {self.throttled:.1f}s throttled, '
+                f'{self.backoff:.1f}s backing off')
+
+
+Scheduler = None
+
+
+def get_scheduler(state_file=None):
+    # one scheduler for all the GspreadDBs of the process
+    global Scheduler
+
+    if Scheduler is None:
+        Scheduler = RequestScheduler(state_file=state_file)
+    return Scheduler
+
+
+class GspreadBatch:
+    # writes of a GspreadDB left in the scheduler's queue until commit()
+    # sends them, merged into as few batch updates as the queue allows
+    def __init__(self, db):
+        self.db = db
+        self.rows = 0
+        self.requests = 0
+
+    def commit(self):
+        sent = self.db.scheduler.requests
+        self.db.flush()
+        self.requests += self.db.scheduler.requests - sent
+        rows, self.rows = self.rows, 0
+        return rows
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
 
 
 class GspreadDB:
@@ -11,12 +324,16 @@ class GspreadDB:
         scope = ['https://spreadsheets.google.com/feeds',
                  'https://www.googleapis.com/auth/drive']
         creds = ServiceAccountCredentials.from_json_keyfile_name(json, scope)
-        client = gspread.authorize(creds)
+        # the quota is the service account's, whatever directory runs it
+        quota_file = os.path.join(os.path.dirname(os.path.abspath(json)), QuotaFile) if QuotaFile else None
+        self.scheduler = get_scheduler(quota_file)
+        client = self.scheduler.install(gspread.authorize(creds))
         self.dbtype = dbtype
         self.workbook = client.open(wbname)
         self.logsheet = self.workbook.worksheet('LOG')
         self.stocklist = self.workbook.worksheet('Stock List').get_all_records()
         self.stocksheet = {}
+        self.missing = {}       # stock name: time its sheet was not found
 
     def getstockticker(self, stockname):
         # find and return existing stock
@@ -31,44 +348,229 @@ class GspreadDB:
         if stockname in self.stocksheet:
             return self.stocksheet[stockname]
 
+        # unlisted stocks and missing sheets are not asked for on every
+        # tick, only again after a while
         ticker = self.getstockticker(stockname)
+        if ticker is None or time.time() - self.missing.get(stockname, 0) < SheetRecheck:
+            raise ValueError("Undefined stock '%s'" % stockname)
         try:
             sh = self.workbook.worksheet(ticker)
             self.stocksheet[stockname] = sh
+            self.missing.pop(stockname, None)
             return sh
         except WorksheetNotFound:
+            self.missing[stockname] = time.time()
             raise ValueError("Undefined stock '%s'" % stockname)
 
+    def loadsheets(self, stocknames):
+        # worksheets of the stocks not seen yet, all in one request
+        now = time.time()
+        stocknames = [x for x in stocknames if x not in self.stocksheet
+                      and now - self.missing.get(x, 0) >= SheetRecheck]
+        if not stocknames:
+            return
+        sheets = dict((sh.title, sh) for sh in self.workbook.worksheets())
+        for stockname in stocknames:
+            ticker = self.getstockticker(stockname)
+            if ticker in sheets:
+                self.stocksheet[stockname] = sheets[ticker]
+                self.missing.pop(stockname, None)
+            else:
+                self.missing[stockname] = now
+
+    def pasterow(self, sheet, cells, insert=False):
+        # cells to row 2 of sheet, in a new row when insert, as batch
+        # requests; pasted text is parsed like USER_ENTERED values
+        data = '\t'.join(' '.join(str(x).split()) for x in cells)
+        paste = {'pasteData': {
+            'coordinate': {'sheetId': sheet.id, 'rowIndex': 1, 'columnIndex': 0},
+            'data': data, 'delimiter': '\t', 'type': 'PASTE_NORMAL'}}
+        if not insert:
+            return [paste]
+        return [{'insertDimension': {
+            'range': {'sheetId': sheet.id, 'dimension': 'ROWS', 'startIndex': 1, 'endIndex': 2},
+            'inheritFromBefore': False}}, paste]
+
+    def flush(self):
+        # send the writes queued for this workbook
+        self.scheduler.flush(self.workbook.id)
+
     def append(self, stockname, time, iopv):
         sheet = self.getstocksheet(stockname)
         sheet.append_row([time, iopv], value_input_option='USER_ENTERED')
 
     def add(self, stockname, time, iopv):
         sheet = self.getstocksheet(stockname)
-        sheet.insert_row([time, iopv], 2, value_input_option='USER_ENTERED')
+        self.scheduler.queue(self.workbook, self.pasterow(sheet, [time, iopv], insert=True))
 
     def addchange(self, stockname, time, iopv):
-        sheet = self.getstocksheet(stockname)
-        iopv0 = float(iopv)
+        errors = self.addchange_many(time, [(stockname, iopv)])
+        if errors:
+            raise errors[stockname]
 
+    def addchange_many(self, time, changes):
+        # a new row for [(stockname, iopv), ...] when the price moved, or
+        # the time of row 2 moved on when it is the second tick of the
+        # same price. B2:B3 of every sheet are read in one batch get, the
+        # inserts and updates are queued into one batch update. Returns
+        # {stockname: ValueError} for the stocks that were skipped, among
+        # them sheets whose B2:B3 are not numbers.
+        errors = {}
+        self.loadsheets([name for name, iopv in changes])
+        rows = []
+        for stockname, iopv in changes:
+            try:
+                sheet = self.getstocksheet(stockname)
+                rows.append((stockname, sheet, float(iopv), iopv))
+            except ValueError as ve:
+                errors[stockname] = ve
+        if not rows:
+            return errors
+
+        ranges = [absolute_range_name(sheet.title, 'B2:B3') for stockname, sheet, iopv0, iopv in rows]
+        resp = self.workbook.values_batch_get(ranges, params={'valueRenderOption': 'UNFORMATTED_VALUE'})
+        for (stockname, sheet, iopv0, iopv), values in zip(rows, resp.get('valueRanges', [])):
+            try:
+                batch = self.changerow(sheet, time, iopv0, iopv, values.get('values', []))
+            except ValueError as ve:
+                errors[stockname] = ve
+                continue
+            self.scheduler.queue(self.workbook, batch, self.redochange(sheet, time, iopv0, iopv))
+
+        return errors
+
+    def changerow(self, sheet, time, iopv0, iopv, last):
+        # requests of a tick given B2:B3 of its sheet, empty cells of a
+        # new sheet are no price, anything else must be a number
+        last = [x[0] if x and x[0] != '' else -1 for x in last] + [-1, -1]
         try:
-            iopv1 = float(sheet.get('B2', value_render_option='UNFORMATTED_VALUE')[0][0])
-        except KeyError:
-            iopv1 = -1
-        try:
-            iopv2 = float(sheet.get('B3', value_render_option='UNFORMATTED_VALUE')[0][0])
-        except KeyError:
-            iopv2 = -1
-
-        if iopv0 != iopv1:
-            sheet.insert_row([time, iopv], 2, value_input_option='USER_ENTERED')
-        elif iopv1 != iopv2:
-            sheet.insert_row([time, iopv], 2, value_input_option='USER_ENTERED')
-        else:
-            sheet.update('A2', time, value_input_option='USER_ENTERED')
+            iopv1, iopv2 = float(last[0]), float(last[1])
+        except ValueError:
+            raise ValueError(f"Non-numeric IOPV in '{sheet.title}'!B2:B3: {last[:2]}")
+
+        if iopv0 != iopv1 or iopv1 != iopv2:
+            return self.pasterow(sheet, [time, iopv], insert=True)
+        return self.pasterow(sheet, [time])
+
+    def redochange(self, sheet, time, iopv0, iopv):
+        # for a tick that may have been written: nothing when row 2 holds
+        # its time, else the tick worked out again on B2:B3 as they are
+        def redo():
+            values = sheet.get('A2:B3', value_render_option='UNFORMATTED_VALUE')
+            if values and values[0] and same_time(values[0][0], time):
+                return []
+            try:
+                return self.changerow(sheet, time, iopv0, iopv, [x[1:] for x in values])
+            except ValueError as ve:
+                print(f'Sheets: tick of {time} dropped ({ve})', file=sys.stderr)
+                return []
+        return redo
+
+    def upsertdaily_many(self, days):
+        # [(stockname, [date, open, high, low, close]), ...] to row 2 of
+        # each daily sheet, replacing it while the day is still open
+        errors = {}
+        self.loadsheets([name for name, cells in days])
+        rows = []
+        for stockname, cells in days:
+            try:
+                rows.append((self.getstocksheet(stockname), cells))
+            except ValueError as ve:
+                errors[stockname] = ve
+        if not rows:
+            return errors
+
+        ranges = [absolute_range_name(sheet.title, 'A2') for sheet, cells in rows]
+        resp = self.workbook.values_batch_get(ranges)
+        for (sheet, cells), values in zip(rows, resp.get('valueRanges', [])):
+            lastdate = (values.get('values') or [['']])[0][0]
+            self.scheduler.queue(self.workbook, self.pasterow(sheet, cells, insert=lastdate != cells[0]),
+                                 self.redodaily(sheet, cells))
+
+        return errors
+
+    def redodaily(self, sheet, cells):
+        # the day's row is replaced or inserted on row 2 as it is now
+        def redo():
+            values = sheet.get('A2')
+            lastdate = values[0][0] if values and values[0] else ''
+            return self.pasterow(sheet, cells, insert=lastdate != cells[0])
+        return redo
 
     def log(self, time, msg):
-        self.logsheet.insert_row([time, str(msg)], 2, value_input_option='USER_ENTERED')
+        if isinstance(time, datetime):
+            time = time.strftime("%d/%m/%Y %H:%M:%S")
+        self.scheduler.queue(self.workbook, self.pasterow(self.logsheet, [time, msg], insert=True))
+
+    # the storage interface shared with Firework and SqliteStore, keyed
+    # by ticker with "%Y-%m-%d %H:%M:%S" timestamps. Ticks go to an IOPV
+    # workbook, daily bars to a DAILY one, the other kind is not written.
+    # Without a batch the writes are sent at once.
+
+    def batch(self):
+        return GspreadBatch(self)
+
+    def written(self, batch, rows):
+        if batch is None:
+            self.flush()
+        else:
+            batch.rows += rows
+
+    @property
+    def stock_list(self):
+        return dict((row['STOCK'], row['TICKER']) for row in self.stocklist)
+
+    def resolve_ticker(self, stockname):
+        # sheets are added by hand, unknown stocks have no ticker
+        return self.getstockticker(stockname)
+
+    def getstockname(self, ticker):
+        for row in self.stocklist:
+            if row['TICKER'] == ticker:
+                return row['STOCK']
+        raise ValueError("Undefined ticker '%s'" % ticker)
+
+    def append_ticks(self, timestamp, ticks, batch=None):
+        if self.dbtype != 'IOPV':
+            return
+        time = datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S").strftime("%d/%m/%Y %H:%M:%S")
+        errors = self.addchange_many(time, [(self.getstockname(x), iopv) for x, iopv in ticks.items()])
+        self.written(batch, len(ticks) - len(errors))
+        if errors:
+            raise next(iter(errors.values()))
+
+    def upsert_daily(self, date, bars, batch=None):
+        if self.dbtype != 'DAILY':
+            return
+        date = datetime.strptime(date, "%Y-%m-%d").strftime("%d/%m/%Y")
+        days = [(self.getstockname(ticker), [date, bar['OPEN'], bar['HIGH'], bar['LOW'], bar['CLOSE']])
+                for ticker, bar in bars.items()]
+        errors = self.upsertdaily_many(days)
+        self.written(batch, len(days) - len(errors))
+        if errors:
+            raise next(iter(errors.values()))
+
+    def read_range(self, tickers, start=None, end=None, daily=False, result='rows'):
+        # whole sheets are read and filtered, rows come back oldest first
+        column, form = ('DATE', "%d/%m/%Y") if daily else ('TIME', "%d/%m/%Y %H:%M:%S")
+        fields = ['OPEN', 'HIGH', 'LOW', 'CLOSE'] if daily else ['IOPV']
+        stock_data = {}
+        for ticker in tickers or self.stock_list.values():
+            sheet = self.getstocksheet(self.getstockname(ticker))
+            rows = []
+            for rec in sheet.get_all_records():
+                date = datetime.strptime(rec[column], form)
+                date = str(date.date()) if daily else str(date)
+                if (start and date < start) or (end and date[:len(end)] > end):
+                    continue
+                rows.append({**dict((x, rec[x]) for x in fields), 'DATE': date})
+            if rows:
+                stock_data[ticker] = sorted(rows, key=lambda x: x['DATE'])
+        if result == 'rows':
+            return stock_data
+
+        from fireworks import rows_columns, columns_result
+        return columns_result(rows_columns(stock_data, fields), result)
 
     def getdatarow(self, stockname, row):
         sheet = self.getstocksheet(stockname)
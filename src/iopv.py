@@ -1,18 +1,25 @@
-from requests_html import HTMLSession
-from bs4 import BeautifulSoup
 from datetime import datetime
 from pprint import pprint
+import requests
+import html as htmllib
+import json
+import hashlib
+import glob
+import os.path
 import time
 import getopt
 import sys
-import re
-import string
 from urllib.parse import urlparse
+from websession import WebSession
+from etftable import parse_rows
 
 Url = "https://www.bursamarketplace.com/mkt/themarket/etf"
+FeedUrl = "https://www.bursamarketplace.com/index.php"
+FeedParams = {'tpl': 'etf_ajax', 'type': 'listing', 'sfield': 'name', 'stype': 'desc'}
+FeedTimeout = 10    # seconds allowed for each feed request
 Options = {}
-MaxRetry = 3
-RetryInterval = 3  # wait this many seconds before trying to reload webpage
+RenderTimeout = 20  # give up if the IOPV table is not filled in by then
+LiteRender = True   # block images, fonts, css and third party scripts
 GetAllStocks = False
 OutputFile = ""
 HtmlFile = ""
@@ -22,32 +29,183 @@ JsonFile = 'iopv.json'
 StockListFile = ''
 StockList = []
 
+# the ETF table is ready once any IOPV cell holds a number
+TableReady = """() => Array.from(
+    document.querySelectorAll('.tb_row.tb_data .tb_iopv')
+).some(cell => /[0-9]/.test(cell.textContent))"""
+
 
 def parse_html(html):
-    soup = BeautifulSoup(html, "lxml")
-    etfs = soup.find_all(class_="tb_row tb_data")
     iopvinfo = {}
-    for row in etfs:
-        tbname = row.find(class_="tb_name")
-        tbiopv = row.find(class_="tb_iopv")
-        if tbname and tbiopv:
-            name = tbname.get_text().split('\xa0')[-1]
-            val = tbiopv.get_text()
-            iopv_str = re.sub(f'[^{re.escape(string.printable)}]', '', val)
+    for name, iopv_str in parse_rows(html):
+        try:
+            iopv = float(iopv_str)
+        except ValueError:
+            iopv = iopv_str
+        iopvinfo[name] = iopv
+
+    return iopvinfo
+
+
+def parse_feed(pages):
+    # same {name: iopv} mapping the page's own javascript would render
+    iopvinfo = {}
+    for page in pages:
+        for rec in page.get('records', []):
+            name = htmllib.unescape(rec['name'])
             try:
-                iopv = float(iopv_str)
-            except ValueError:
-                iopv = iopv_str
+                iopv = float(rec['iopv'])
+            except (TypeError, ValueError):
+                iopv = '-'
+            if not isinstance(iopv, float) or iopv <= 0:
+                iopv = '-'
             iopvinfo[name] = iopv
 
     return iopvinfo
 
 
+def parse_codes(pages):
+    # {name: code} of the feed records, the code of a detail page is the
+    # stock code without its '.KL' suffix, e.g. TRCM
+    codes = {}
+    for page in pages:
+        for rec in page.get('records', []):
+            code = rec.get('stockcode') or ''
+            if code:
+                codes[htmllib.unescape(rec['name'])] = code[:-3] if code.endswith('.KL') else code
+
+    return codes
+
+
+class WebSource:
+    # render the ETF page in headless Chromium
+    def __init__(self, url=Url, session=None, timeout=RenderTimeout):
+        self.url = url
+        self.session = session
+        self.timeout = timeout
+        self.ready_time = None
+
+    def fetch(self):
+        # reuse the warm browser page of a long-running session if given
+        session = self.session or WebSession(self.url, lite=LiteRender)
+        try:
+            html = session.render(ready=TableReady, timeout=self.timeout)
+        finally:
+            if not self.session:
+                session.close()
+
+        self.ready_time = session.ready_time
+        iopv_data = parse_html(html)
+        if not iopv_data:
+            raise TimeoutError
+        return iopv_data
+
+
+class FileSource:
+    # parse a saved copy of the ETF page
+    def __init__(self, filename):
+        self.filename = filename
+        self.ready_time = None
+
+    def fetch(self):
+        with open(self.filename, "rb") as f:
+            html = f.read()
+        return parse_html(html)
+
+
+class FeedSource:
+    # call the JSON feed behind the ETF page, no browser involved
+    def __init__(self, url=FeedUrl, record_dir=None, timeout=FeedTimeout):
+        self.url = url
+        self.record_dir = record_dir
+        self.timeout = timeout
+        self.ready_time = None
+        self.http = requests.Session()     # keeps connections alive between ticks
+
+    def get_page(self, pagenum):
+        params = {**FeedParams, 'pagenum': pagenum}
+        resp = self.http.get(self.url, params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get_pages(self):
+        pages = [self.get_page(1)]
+        total = int(pages[0].get('totalpage') or 1)
+        for pagenum in range(2, total + 1):
+            pages.append(self.get_page(pagenum))
+        return pages
+
+    def fetch(self):
+        start = time.time()
+        pages = self.get_pages()
+        self.ready_time = time.time() - start
+
+        if self.record_dir:
+            self.record(pages)
+
+        iopv_data = parse_feed(pages)
+        if not iopv_data:
+            raise TimeoutError
+        return iopv_data
+
+    def record(self, pages):
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        filename = os.path.join(self.record_dir, f'feed-{stamp}.json')
+        with open(filename, 'w') as f:
+            json.dump(pages, f)
+
+
+class ReplaySource:
+    # play back feed responses saved by FeedSource, one file per fetch in
+    # the order recorded; keep the one source across ticks
+    def __init__(self, path):
+        if os.path.isdir(path):
+            self.files = sorted(glob.glob(os.path.join(path, 'feed-*.json')))
+        else:
+            self.files = [path]
+        if not self.files:
+            raise FileNotFoundError(f'no recorded feed in {path}')
+        self.index = 0
+        self.ready_time = None
+
+    def fetch(self):
+        if self.index >= len(self.files):
+            raise EOFError(f'all {len(self.files)} recorded feeds played')
+        filename = self.files[self.index]
+        self.index += 1
+        with open(filename) as f:
+            pages = json.load(f)
+        return parse_feed(pages)
+
+
+def fingerprint(iopv_data):
+    # digest of a parsed table, equal tables give equal fingerprints
+    items = sorted((k, str(v)) for k, v in iopv_data.items())
+    return hashlib.sha1(json.dumps(items).encode()).hexdigest()
+
+
+def make_source(source):
+    result = urlparse(source)
+    is_url = all([result.scheme, result.netloc])
+    if is_url:
+        return WebSource(source)
+    elif os.path.isdir(source) or source.endswith('.json'):
+        return ReplaySource(source)
+    else:
+        return FileSource(source)
+
+
 class IopvParser:
-    def __init__(self, source=Url):
+    def __init__(self, source=Url, session=None):
+        # source is a url, a file or directory name, or a source object
+        if isinstance(source, str):
+            source = make_source(source)
+            if session:
+                source.session = session
         self.source = source
-        self.max_retry = MaxRetry
         self.iopv_data = None
+        self.fingerprint = None
+        self.ready_time = None
         self.load_iopv()
 
     def iopv(self, stock, default=None):
@@ -55,44 +213,25 @@ class IopvParser:
         return self.iopv_data.get(stock, default)
 
     def load_iopv(self):
-        result = urlparse(self.source)
-        is_url = all([result.scheme, result.netloc])
-        if is_url:
-            self.get_iopv_from_web()
-        else:
-            self.get_iopv_from_file()
-
-    def get_iopv_from_web(self):
-        # create an HTML Session object
-        session = HTMLSession()
-
-        # Use the object above to connect to needed webpage
-        resp = session.get(self.source)
-        for i in range(self.max_retry):
-            # Run JavaScript code on webpage to load stock data
-            resp.html.render()
-
-            # extract stock info
-            iopv_data = parse_html(resp.html.html)
-            if iopv_data:
-                self.iopv_data = iopv_data
-                return
-
-            # wait before reloading data
-            time.sleep(RetryInterval)
-
-        raise TimeoutError
+        self.iopv_data = self.source.fetch()
+        self.fingerprint = fingerprint(self.iopv_data)
+        self.ready_time = self.source.ready_time
 
-    def get_iopv_from_file(self):
-        f = open(self.source, "rb")
-        html = f.read()
-        self.iopv_data = parse_html(html)
+    def changes(self, previous, previous_fingerprint=None):
+        # {name: iopv} of the stocks that differ from a previous table
+        if not previous:
+            return dict(self.iopv_data)
+        if previous_fingerprint is None:
+            previous_fingerprint = fingerprint(previous)
+        if previous_fingerprint == self.fingerprint:
+            return {}
+        return dict((k, v) for k, v in self.iopv_data.items() if previous.get(k) != v)
 
 
 if __name__ == "__main__":
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv, 'i:')
+        opts, args = getopt.getopt(argv, 'Fi:r:')
         Options = dict(opts)
         if '-i' in Options.keys():
             HtmlFile = Options['-i']
@@ -102,6 +241,8 @@ if __name__ == "__main__":
 
     if HtmlFile:
         iopv1 = IopvParser(HtmlFile)
+    elif '-F' in Options.keys():
+        iopv1 = IopvParser(FeedSource(record_dir=Options.get('-r')))
     else:
         iopv1 = IopvParser(Url)
 
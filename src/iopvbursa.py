@@ -1,18 +1,18 @@
-from requests_html import HTMLSession
-from bs4 import BeautifulSoup
 from datetime import datetime
 import time
 import pprint
 import getopt
 import sys
 import re
-import string
 import gspreaddb
+from websession import WebSession
+from iopv import TableReady, LiteRender
+from etftable import parse_rows
 
 Url = "http://www.bursamarketplace.com/mkt/themarket/etf"
 Options = {}
-MaxRetry = 3
-RetryInterval = 3       # wait this many seconds before trying to reload webpage
+RenderTimeout = 20      # give up if the IOPV table is not filled in by then
+ReadyTime = None        # seconds the last live download took to show data
 GetAllStocks = False
 OutputFile = ""
 HtmlFile = ""
@@ -23,44 +23,31 @@ StockListFile = ''
 StockList = []
 
 def getstockdata(html):
-    soup = BeautifulSoup(html, "lxml")
-    etfs = soup.find_all(class_="tb_row tb_data")
     iopvinfo = []
-    for row in etfs:
-        tbname = row.find(class_="tb_name")
-        tbiopv = row.find(class_="tb_iopv")
-        if tbname and tbiopv:
-            name = tbname.get_text().split('\xa0')[-1]
-            if GetAllStocks or name in StockList:
-                info = [name]
-                val = tbiopv.get_text()
-                iopv = re.sub(f'[^{re.escape(string.printable)}]', '', val)
-                info.append(iopv)
-                iopvinfo.append(info)
-    
+    for name, iopv in parse_rows(html):
+        if GetAllStocks or name in StockList:
+            iopvinfo.append([name, iopv])
+
     return iopvinfo
 
 def getstocklive():
-    # create an HTML Session object
-    session = HTMLSession()
-     
-    # Use the object above to connect to needed webpage
-    resp = session.get(Url)
-    for i in range(MaxRetry):
-        # Run JavaScript code on webpage to load stock data
-        resp.html.render()
-
-        # extract stock info
-        iopvinfo = getstockdata(resp.html.html)
-        if iopvinfo:
-            return iopvinfo
-
-        # wait before reloading data
-        time.sleep(RetryInterval)
-
-    # loop timeout
-    print("WARNING:\tmax retry exceeded!\n")
-    raise TimeoutError
+    global ReadyTime
+
+    # render the page and poll until the IOPV cells are filled in
+    session = WebSession(Url, lite=LiteRender)
+    try:
+        html = session.render(ready=TableReady, timeout=RenderTimeout)
+    except TimeoutError:
+        print("WARNING:\tIOPV data not ready before deadline!\n")
+        raise
+    finally:
+        session.close()
+
+    ReadyTime = session.ready_time
+    iopvinfo = getstockdata(html)
+    if not iopvinfo:
+        raise TimeoutError
+    return iopvinfo
 
 def getiopvfromfile(fn):
     f = open(fn, "rb")
@@ -103,14 +90,14 @@ def runmain(args):
             db.log(nowtime, "Timeout on downloading data")
             return
 
-        for stock in iopvinfo:
-            try:
-                name, iopv = stock
-                db.addchange(name, nowtime, iopv)
-            except ValueError as ve:
-                db.log(nowtime, f'ERROR updating {name}: {ve}')
+        # one read and one write request for all the stocks
+        errors = db.addchange_many(nowtime, iopvinfo)
+        for name, ve in errors.items():
+            db.log(nowtime, f'ERROR updating {name}: {ve}')
 
-        db.log(nowtime, "stock update completed.")
+        db.log(nowtime, f"stock update completed (data ready in {ReadyTime:.3f}s).")
+        db.flush()
+        print(f'Sheets: {db.scheduler.report()}')
     else:
         iopvinfo = getstocklive()
         for stock in iopvinfo:
@@ -123,7 +110,7 @@ if __name__ == "__main__":
     argv = sys.argv[1:]
     try:
         # parse command line options
-        opts, args = getopt.getopt(argv, 'ab:ghi:j:l:L:o:w:')
+        opts, args = getopt.getopt(argv, 'ab:ghi:j:L:o:w:')
         Options = dict(opts)
         if '-h' in Options.keys():
             showhelp()
@@ -135,14 +122,11 @@ if __name__ == "__main__":
         if '-o' in Options.keys():
             OutputFile = Options['-o']
 
-        if '-l' in Options.keys():
-            MaxRetry = Options['-l']
-
         if '-i' in Options.keys():
             HtmlFile = Options['-i']
 
         if '-w' in Options.keys():
-            RetryInterval = Options['-w']
+            RenderTimeout = float(Options['-w'])
 
         if '-g' in Options.keys():
             SaveToDBase = True
@@ -7,7 +7,10 @@ import getopt
 import sys
 import re
 import string
+import pandas as pd
 from gspreaddb import GspreadDB
+from fireworks import daily_ohlc
+from iopvstore import open_store
 
 Options = {}
 GetAllStocks = False
@@ -18,6 +21,7 @@ SaveToDBase = False
 DailyDbName = 'iopvdb-daily'
 SourceDbName = 'iopvdb2'
 JsonFile = 'iopv.json'
+StoreSpec = None        # e.g. 'sqlite:iopv-store.sqlite', None for the sheets
 
 def dlog(*args, **kwargs):
     if DebugMode: 
@@ -70,15 +74,16 @@ def updatedaily(args):
     nowtime = now.strftime("%d/%m/%Y %H:%M:%S")
 
     # connect to google sheets
-    dailydb = GspreadDB(DailyDbName, JsonFile)
-    stockdb = GspreadDB(SourceDbName, JsonFile)
+    dailydb = GspreadDB(DailyDbName, 'DAILY', JsonFile)
+    stockdb = GspreadDB(SourceDbName, 'IOPV', JsonFile)
 
-    # update data to google sheets
+    # update data to google sheets, the daily rows of all the stocks go
+    # out in one batch
+    days = []
     for stock in args:
         dlog("Updating %s" % stock)
         try:
             tickersheet = stockdb.getstocksheet(stock)
-            dailysheet = dailydb.getstocksheet(stock)
         except ValueError as ve:
             dailydb.log(nowtime, ve)
             continue
@@ -86,15 +91,37 @@ def updatedaily(args):
         trecs = tickersheet.get_all_records()
         dopen, high, low, close = getdaily(nowdate, trecs)
         dlog(nowdate, dopen, high, low, close)
-        lastdaily = dailysheet.row_values(2)
-        lastdate = lastdaily[0]
-        cells = [nowdate, dopen, high, low, close]
-        if lastdate == nowdate:
-            dailysheet.update('A2', [cells], value_input_option='USER_ENTERED')
+        days.append((stock, [nowdate, dopen, high, low, close]))
+
+    errors = dailydb.upsertdaily_many(days)
+    for stock, cells in days:
+        if stock in errors:
+            dailydb.log(nowtime, errors[stock])
         else:
-            dailysheet.insert_row(cells, 2, value_input_option='USER_ENTERED')
+            dailydb.log(nowtime, "stock update completed for '%s'." % stock)
+    dailydb.flush()
+    dlog(dailydb.scheduler.report())
 
-        dailydb.log(nowtime, "stock update completed for '%s'." % stock)
+def updatestore(args):
+    # same as updatedaily() on a store that holds both ticks and bars
+    now = datetime.now()
+    nowdate = str(now.date())
+    store = open_store(StoreSpec)
+
+    tickers = dict((stock, store.resolve_ticker(stock)) for stock in args)
+    ticks = store.read_range([x for x in tickers.values() if x], nowdate, nowdate)
+    rows = [(x['DATE'], ticker, x['IOPV']) for ticker, data in ticks.items() for x in data]
+    bars = daily_ohlc(pd.DataFrame(rows, columns=['DATE', 'TICKER', 'IOPV']))
+    bars = dict((bar.TICKER, {'OPEN': bar.OPEN, 'HIGH': bar.HIGH, 'LOW': bar.LOW,
+                              'CLOSE': bar.CLOSE}) for bar in bars.itertuples(index=False))
+    dlog(nowdate, bars)
+    store.upsert_daily(nowdate, bars)
+
+    for stock, ticker in tickers.items():
+        if ticker in bars:
+            store.log(now, "stock update completed for '%s'." % stock)
+        else:
+            store.log(now, "no IOPV today for '%s'." % stock)
 
 def initstock(args):
     nowtime = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
@@ -145,6 +172,8 @@ def runmain(args):
 
     if Initialize:
         initstock(args)
+    elif StoreSpec:
+        updatestore(args)
     else:
         updatedaily(args)
 
@@ -155,7 +184,7 @@ if __name__ == "__main__":
     argv = sys.argv[1:]
     try:
         # parse command line options
-        opts, args = getopt.getopt(argv, 'ab:DghIjL::s:')
+        opts, args = getopt.getopt(argv, 'ab:DghIjL::s:S:')
         Options = dict(opts)
         if '-h' in Options.keys():
             showhelp()
@@ -188,6 +217,9 @@ if __name__ == "__main__":
         if '-L' in Options.keys():
             StockListFile = Options['-L']
 
+        if '-S' in Options.keys():
+            StoreSpec = Options['-S']
+
         runmain(args)
 
     except getopt.GetoptError:
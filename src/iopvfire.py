@@ -3,9 +3,14 @@ import pprint
 import getopt
 import sys
 import os.path
-from iopv import IopvParser
+import json
+from iopv import IopvParser, WebSource, FeedSource, ReplaySource, Url, LiteRender
 from fireworks import Firework
-from utils import getstocklist
+from firequeue import FireQueue, WalFile
+from iopvstore import open_store
+from crontab import Crontab
+from websession import WebSession, MaxRenders, MaxMemory
+from utils import getstocklist, statefile, save_json
 from pprint import pprint
 from datetime import datetime
 
@@ -13,6 +18,14 @@ from datetime import datetime
 StockList = []
 HtmlFile = None
 IopvArchiveFile = None
+DaemonSpec = None
+Source = None
+IopvStateFile = statefile('iopv-last.json')     # last table seen, to detect changes
+LastIopv = None
+Queue = None                        # write-behind queue, None to write directly
+StoreSpec = None                    # stores to write to instead, see open_store()
+Store = None
+DaemonSpecDefault = "* 9-12,14-17 * * 1-5"
 
 
 def save_to_archive(logtime, iopv_list):
@@ -28,38 +41,149 @@ def save_to_archive(logtime, iopv_list):
             line = f'{timestamp}\t{stock}\t{iopv}\n'
             f.write(line)
 
+
+def load_last_iopv():
+    global LastIopv
+
+    if LastIopv is None and IopvStateFile and os.path.isfile(IopvStateFile):
+        with open(IopvStateFile) as f:
+            LastIopv = json.load(f)
+    return LastIopv
+
+
+def save_last_iopv(logtime, parser):
+    global LastIopv
+
+    timestamp = logtime.strftime("%Y-%m-%d %H:%M:%S")
+    LastIopv = {'DATE': timestamp, 'FINGERPRINT': parser.fingerprint,
+                'IOPV': parser.iopv_data}
+    if IopvStateFile:
+        save_json(IopvStateFile, LastIopv)
+
+
 def iopv_update():
     now = datetime.now()
 
     if HtmlFile:
         parser = IopvParser(HtmlFile)
+    elif Source:
+        parser = IopvParser(Source)
     else:
         parser = IopvParser()
 
-    iopv_list = parser.iopv_data.items()
+    if parser.ready_time is not None:
+        print(f'IOPV data ready in {parser.ready_time:.3f}s')
+
+    # only the stocks that changed since the last tick of the day are
+    # written, the first tick of a day is always a full snapshot
+    last = load_last_iopv()
+    if last and last['DATE'][:10] == str(now.date()):
+        changed = parser.changes(last['IOPV'], last['FINGERPRINT'])
+    else:
+        changed = dict(parser.iopv_data)
+    iopv_list = changed.items()
+    print(f'{len(changed)} of {len(parser.iopv_data)} stocks changed')
 
     # save IOPV data to archive
     save_to_archive(now, iopv_list)
 
-    # update IOPV data to firebase database
-    fire = Firework()
-    fire.update_iopv_list(iopv_list, logtime=now)
+    # update IOPV data to firebase database, through the queue when
+    # running as a daemon so a slow network does not hold up the tick
+    fire = get_store() or Queue or Firework()
+    if changed:
+        fire.update_iopv_list(iopv_list, logtime=now)
+    fire.heartbeat(len(changed), logtime=now)
+    save_last_iopv(now, parser)
+
+
+def get_store():
+    global Store
+
+    # Firebase in the store list goes through the queue when there is one
+    if StoreSpec and Store is None:
+        Store = open_store(StoreSpec, firebase=Queue)
+    return Store
+
+
+def daemon_update():
+    try:
+        iopv_update()
+    except EOFError as err:
+        # a replayed recording has run out, so has the daemon
+        print(f'{err}, stopping')
+        raise SystemExit(0)
+    except Exception as err:
+        # keep the daemon alive, the next tick will try again
+        print(f'ERROR updating IOPV: {err!r}')
+
+
+def start_session(max_renders=MaxRenders, max_memory=MaxMemory):
+    global Source
+
+    # keep one browser page open across ticks, unless reading the feed
+    if Source or HtmlFile:
+        return None
+    session = WebSession(Url, max_renders=max_renders, max_memory=max_memory,
+                         lite=LiteRender)
+    Source = WebSource(Url, session=session)
+    return session
+
+
+def start_queue(wal_file=WalFile):
+    global Queue
+
+    # ticks left in the log by a previous run are sent first
+    Queue = FireQueue(wal_file)
+    Queue.start()
+    return Queue
+
+
+def run_daemon(spec, max_renders=MaxRenders, max_memory=MaxMemory, wal_file=WalFile):
+    session = start_session(max_renders, max_memory)
+    queue = start_queue(wal_file)
+    cron = Crontab(spec, daemon_update)
+    try:
+        cron.run(showtime=True)
+    finally:
+        queue.stop()
+        if session:
+            session.close()
 
 
 if __name__ == "__main__":
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv, 'a:i:L:')
+        opts, args = getopt.getopt(argv, 'a:d:DFi:L:m:n:q:r:s:S:')
         Options = dict(opts)
         if '-i' in Options.keys():
             HtmlFile = Options['-i']
+            if os.path.isdir(HtmlFile) or HtmlFile.endswith('.json'):
+                # a recorded feed, one file per tick
+                Source, HtmlFile = ReplaySource(HtmlFile), None
         if '-L' in Options.keys():
             listfile = Options['-L']
             StockList = getstocklist(listfile)
         if '-a' in Options.keys():
             IopvArchiveFile = Options['-a']
+        if '-D' in Options.keys():
+            DaemonSpec = DaemonSpecDefault
+        if '-d' in Options.keys():
+            DaemonSpec = Options['-d']
+        if '-s' in Options.keys():
+            IopvStateFile = Options['-s']
+        if '-S' in Options.keys():
+            StoreSpec = Options['-S']
+        if '-F' in Options.keys():
+            Source = FeedSource(record_dir=Options.get('-r'))
+        wal_file = Options.get('-q', WalFile)
+        max_renders = int(Options.get('-n', MaxRenders))
+        max_memory = int(Options.get('-m', MaxMemory))
     except getopt.GetoptError:
         print('Invalid command line option or arguments')
         sys.exit(2)
 
-    iopv_update()
+    if DaemonSpec:
+        run_daemon(DaemonSpec, max_renders=max_renders, max_memory=max_memory,
+                   wal_file=wal_file)
+    else:
+        iopv_update()
@@ -0,0 +1,361 @@
+import sys
+import time
+import getopt
+import datetime
+from firemirror import FireMirror
+from fireworks import OhlcAccumulator, ohlc_fields
+
+StoreFile = 'iopv-store.sqlite'
+JsonFile = 'iopv.json'
+
+# The stores share one interface, keyed by ticker with timestamps as
+# "%Y-%m-%d %H:%M:%S" and dates as "%Y-%m-%d":
+#
+#   resolve_ticker(stock)            ticker of a stock name
+#   append_ticks(timestamp, ticks, batch=None)
+#                                    ticks = {ticker: iopv}
+#   upsert_daily(date, bars, batch=None)
+#                                    bars = {ticker: {OPEN, HIGH, LOW, CLOSE}}
+#   batch()                          writes held until batch.commit(), which
+#                                    returns the rows written; batch.requests
+#                                    counts the requests sent
+#   read_range(tickers, start, end, daily=False, result='rows')
+#                                    as get_stock_raw() / get_stock_daily()
+#   log(logtime, msg)
+#
+# Firework (Firebase), GspreadDB (Google Sheets), SqliteStore and
+# ReplicatedStore below implement it; Firework and SqliteStore also take
+# whole ticks of stock names in update_iopv_list() and keep the daily
+# bars themselves.
+
+StoreSchema = """
+CREATE TABLE IF NOT EXISTS stocks (
+    stock TEXT PRIMARY KEY, ticker TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS log (date TEXT NOT NULL, msg TEXT);
+CREATE TABLE IF NOT EXISTS heartbeat (
+    id INTEGER PRIMARY KEY CHECK (id = 0), date TEXT, changed INTEGER);
+"""
+
+
+class SqliteBatch:
+    # writes of a SqliteStore held in one transaction until commit()
+    def __init__(self, store):
+        self.store = store
+        self.rows = 0
+        self.requests = 0
+
+    def commit(self):
+        with self.store.lock:
+            self.store.conn.commit()
+        self.requests += 1
+        rows, self.rows = self.rows, 0
+        return rows
+
+    def __len__(self):
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            with self.store.lock:
+                self.store.conn.rollback()
+
+
+class SqliteStore(FireMirror):
+    # local store in the mirror's tables, written to directly instead of
+    # synced, so every FireMirror read works on it too. Rows are keyed
+    # (ticker, date), which is also the index of the range reads.
+    def __init__(self, db_file=StoreFile):
+        super().__init__(None, db_file)
+        self.conn.executescript(StoreSchema)
+        # one writer, many readers; a power loss may drop the last ticks
+        # but never corrupts the file
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.ohlc = None
+
+    def sync(self, tree, force=False, window=None):
+        return 0
+
+    def write(self, sql, values, batch=None):
+        with self.lock:
+            self.conn.executemany(sql, values)
+            if batch is None:
+                self.conn.commit()
+        if batch is not None:
+            batch.rows += len(values)
+
+    def batch(self):
+        return SqliteBatch(self)
+
+    @property
+    def stock_list(self):
+        return dict(self.query('SELECT stock, ticker FROM stocks', ()))
+
+    def set_stock(self, stock, ticker):
+        # the ticker of a stock as another store has it, goes out with
+        # the open batch, if any
+        with self.lock:
+            pending = self.conn.in_transaction
+            self.conn.execute('INSERT OR REPLACE INTO stocks VALUES (?, ?)', (stock, ticker))
+            if not pending:
+                self.conn.commit()
+
+    def resolve_ticker(self, stock):
+        # new stocks get the next NEWETF-<n> of this store; replicated with
+        # Firebase, ReplicatedStore takes the ticker from there instead
+        with self.lock:
+            row = self.conn.execute('SELECT ticker FROM stocks WHERE stock = ?', (stock,)).fetchone()
+            if row:
+                return row[0]
+            numbers = [int(x[7:]) for x, in self.conn.execute(
+                "SELECT ticker FROM stocks WHERE ticker LIKE 'NEWETF-%'") if x[7:].isdigit()]
+            ticker = f'NEWETF-{max(numbers, default=0) + 1}'
+            # not committed here when a batch is open, it goes with it
+            pending = self.conn.in_transaction
+            self.conn.execute('INSERT INTO stocks VALUES (?, ?)', (stock, ticker))
+            if not pending:
+                self.conn.commit()
+            return ticker
+
+    def append_ticks(self, timestamp, ticks, batch=None):
+        values = [(timestamp, ticker, iopv) for ticker, iopv in ticks.items()]
+        self.write('INSERT OR REPLACE INTO raw VALUES (?, ?, ?)', values, batch)
+
+    def upsert_daily(self, date, bars, batch=None):
+        values = [(date, ticker, *[bar.get(x) for x in ohlc_fields]) for ticker, bar in bars.items()]
+        self.write('INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?)', values, batch)
+
+    def log(self, logtime, msg):
+        self.write('INSERT INTO log VALUES (?, ?)', [(logtime.strftime("%Y-%m-%d %H:%M:%S"), str(msg))])
+
+    def heartbeat(self, changed, logtime=None, batch=None):
+        now = logtime if logtime else datetime.datetime.now()
+        self.write('INSERT OR REPLACE INTO heartbeat VALUES (0, ?, ?)',
+                   [(now.strftime("%Y-%m-%d %H:%M:%S"), changed)], batch)
+
+    def update_iopv_list(self, iopv_list, logtime=None, batch=None):
+        # ticks and the day's bars of their tickers in one transaction.
+        # The running OHLC is kept in memory, a cold start replays the
+        # day from the local ticks, which is cheap here.
+        now = logtime if logtime else datetime.datetime.now()
+        date = str(now.date())
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        ticks = dict((self.resolve_ticker(stock), iopv) for stock, iopv in iopv_list)
+
+        if not self.ohlc:
+            self.ohlc = OhlcAccumulator(None)
+        if self.ohlc.date != date:
+            self.ohlc.replay(date, self.get_day_raw(date))
+        for ticker, iopv in ticks.items():
+            self.ohlc.add(ticker, timestamp, iopv)
+
+        commit = batch is None
+        if commit:
+            batch = self.batch()
+        self.append_ticks(timestamp, ticks, batch)
+        self.upsert_daily(date, dict((x, self.ohlc.ohlc(x)) for x in ticks if x in self.ohlc.bars), batch)
+        if commit:
+            batch.commit()
+
+
+class ReplicatedBatch:
+    # one batch of each store of a ReplicatedStore, None for the stores
+    # that write at once. The primary's batch is committed first and its
+    # failure raised, a replica's is reported.
+    def __init__(self, store):
+        self.store = store
+        self.batches = [x.batch() if hasattr(x, 'batch') else None for x in store.stores]
+
+    @property
+    def requests(self):
+        return sum(x.requests for x in self.batches if x is not None)
+
+    def commit(self):
+        rows = 0
+        for store, batch in zip(self.store.stores, self.batches):
+            if batch is None:
+                continue
+            try:
+                count = batch.commit()
+            except Exception as err:
+                if store is self.store.primary:
+                    raise
+                self.store.report(store, 'commit', err)
+                continue
+            if store is self.store.primary:
+                rows = count
+        return rows
+
+    def __len__(self):
+        batch = self.batches[0]
+        return len(batch) if batch is not None else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+
+class ReplicatedStore:
+    # a primary store that answers reads, and replicas that get a copy
+    # of every write. A failing replica is reported, not raised, so the
+    # remote stores cannot hold up the local one.
+    def __init__(self, primary, *replicas):
+        self.primary = primary
+        self.replicas = replicas
+        self.stores = (primary,) + replicas
+        self.tickers = {}
+
+    def __getattr__(self, name):
+        # reads and anything else go to the primary
+        return getattr(self.primary, name)
+
+    def report(self, store, name, err):
+        print(f'{type(store).__name__}.{name} failed: {err!r}', file=sys.stderr)
+
+    def replicate(self, name, *args, batch=None, **kwargs):
+        # each store gets its own batch of a ReplicatedBatch
+        result = None
+        for i, store in enumerate(self.stores):
+            func = getattr(store, name) if store is self.primary else getattr(store, name, None)
+            if func is None:
+                continue
+            if batch is not None and batch.batches[i] is not None:
+                kwargs['batch'] = batch.batches[i]
+            else:
+                kwargs.pop('batch', None)
+            try:
+                value = func(*args, **kwargs)
+            except Exception as err:
+                if store is self.primary:
+                    raise
+                self.report(store, name, err)
+                continue
+            if store is self.primary:
+                result = value
+        return result
+
+    def batch(self):
+        return ReplicatedBatch(self)
+
+    def resolve_ticker(self, stock):
+        # one ticker in every store: the first store that keeps its own
+        # stock list (Firebase, the sheets) and knows or allocates the
+        # stock decides, and the local stores are told. Only when none
+        # does, e.g. Firebase is down, the primary allocates one itself.
+        if stock in self.tickers:
+            return self.tickers[stock]
+        ticker = None
+        shared = [x for x in self.stores if not hasattr(x, 'set_stock')]
+        for store in shared + [x for x in [self.primary] if x not in shared]:
+            func = getattr(store, 'resolve_ticker', None)
+            if func is None:
+                continue
+            try:
+                ticker = func(stock)
+            except Exception as err:
+                if store is self.primary:
+                    raise
+                self.report(store, 'resolve_ticker', err)
+                continue
+            if ticker:
+                break
+        if not ticker:
+            return None
+        for store in self.stores:
+            if hasattr(store, 'set_stock'):
+                store.set_stock(stock, ticker)
+        self.tickers[stock] = ticker
+        return ticker
+
+    def append_ticks(self, timestamp, ticks, batch=None):
+        self.replicate('append_ticks', timestamp, ticks, batch=batch)
+
+    def upsert_daily(self, date, bars, batch=None):
+        self.replicate('upsert_daily', date, bars, batch=batch)
+
+    def log(self, logtime, msg):
+        self.replicate('log', logtime, msg)
+
+    def update_iopv_list(self, iopv_list, logtime=None, batch=None):
+        # by stock name, with the tickers settled first so that every
+        # store resolves them the same
+        iopv_list = list(iopv_list)
+        for stock, iopv in iopv_list:
+            self.resolve_ticker(stock)
+        self.replicate('update_iopv_list', iopv_list, logtime=logtime, batch=batch)
+
+    def heartbeat(self, changed, logtime=None, batch=None):
+        self.replicate('heartbeat', changed, logtime=logtime, batch=batch)
+
+
+def open_one(spec, firebase=None):
+    kind, _, arg = spec.partition(':')
+    if kind == 'sqlite':
+        return SqliteStore(arg or StoreFile)
+    if kind == 'firebase':
+        if firebase is not None:
+            return firebase
+        from fireworks import Firework
+        return Firework(mirror_file=arg or None)
+    if kind == 'gspread':
+        from gspreaddb import GspreadDB
+        wbname, _, dbtype = arg.partition(':')
+        return GspreadDB(wbname, dbtype or 'IOPV', JsonFile)
+    raise ValueError(f"Unknown store '{spec}'")
+
+
+def open_store(spec, firebase=None):
+    # spec is a comma separated list of stores, the first one is the
+    # primary and the others replicas:
+    #   sqlite[:<file>]                   local SQLite file
+    #   firebase[:<mirror file>]          Firebase, reads from a mirror
+    #   gspread:<workbook>[:IOPV|DAILY]   Google Sheets
+    # firebase, when given, is used for 'firebase' instead of a new
+    # Firework, e.g. a FireQueue in front of one
+    stores = [open_one(x.strip(), firebase) for x in spec.split(',')]
+    return stores[0] if len(stores) == 1 else ReplicatedStore(*stores)
+
+
+def copy_store(src, dst, start=None, end=None):
+    # the stock list and the history from start to end of one store into
+    # another, e.g. to seed a local store from Firebase
+    for stock, ticker in src.stock_list.items():
+        dst.set_stock(stock, ticker)
+    batch = dst.batch()
+    count = 0
+    for daily in (False, True):
+        by_date = {}
+        for ticker, rows in src.read_range(None, start, end, daily).items():
+            for row in rows:
+                value = dict((x, row[x]) for x in ohlc_fields) if daily else row['IOPV']
+                by_date.setdefault(row['DATE'], {})[ticker] = value
+        write = dst.upsert_daily if daily else dst.append_ticks
+        for date, values in sorted(by_date.items()):
+            write(date, values, batch)
+        count += batch.commit()
+    return count
+
+
+if __name__ == "__main__":
+    # seed a local store: iopvstore.py [-f <from spec>] [-s <start>] [-e <end>] <sqlite file>
+    argv = sys.argv[1:]
+    try:
+        opts, args = getopt.getopt(argv, 'e:f:s:')
+        Options = dict(opts)
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    src = open_store(Options.get('-f', 'firebase'))
+    dst = SqliteStore(args[0] if args else StoreFile)
+    start = time.time()
+    count = copy_store(src, dst, Options.get('-s'), Options.get('-e'))
+    print(f'{count} rows copied in {time.time() - start:.1f}s')
@@ -1,83 +1,107 @@
-# import HTMLSession from requests_html
-from requests_html import HTMLSession
 from bs4 import BeautifulSoup
 from datetime import datetime
+import asyncio
 import time
 import pprint
 import getopt
 import sys
+import re
+from websession import TabPool, Tabs
+from iopv import FeedSource, parse_codes
+from utils import getstocklist
 
 lookup = ("IOPV", "IOPV Chg")
 Options = {}
+EtfUrl = "http://www.bursamarketplace.com/mkt/themarket/etf"
+RenderTimeout = 20      # seconds allowed for each detail page
 
-def getstockupdate(resp, stockid):
+# the detail page is filled in once its first data item has a value
+DetailReady = """() => {
+    const cell = document.querySelector('div.dataItem_hld .value');
+    return cell !== null && cell.textContent.trim().length > 0;
+}"""
+
+
+def getstockdata(html):
+    # extract stock info
+    soup = BeautifulSoup(html, "lxml")
+
+    toppnl = soup.find(class_="topPnl_name")
+    tbl = soup.select("div.dataItem_hld")
+    stocktbl = [(elem.get_text(), elem.find(class_="value").get_text()) for elem in tbl]
+
+    iopvinfo = {}
+    iopvinfo['stock name'] = toppnl.get_text() if toppnl else ''
+    for elem in stocktbl:
+        name = elem[0].split("\n")[1]
+        if name in lookup:
+            iopvinfo[name] = elem[1]
+
+    return iopvinfo
+
+
+def getstockcodes(stocks):
+    # stock names are looked up in the ETF feed (the listing page is
+    # rendered by javascript, its html has no rows), page codes pass through
+    if all(re.fullmatch('[A-Z0-9]+', x) for x in stocks):
+        return stocks
+
+    codes = parse_codes(FeedSource().get_pages())
+    return [codes.get(x, x) for x in stocks]
+
+
+async def getstockupdate(pool, stockid, timeout):
+    now = datetime.now()
+    dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
+    url = f'{EtfUrl}/{stockid}'
+    try:
+        html, elapsed = await pool.render(url, ready=DetailReady, timeout=timeout)
+    except Exception as err:
+        print(f"{stockid}: {err}", file=sys.stderr)
+        return [dt_string, stockid, 'TIMEOUT', '']
+
+    iopvinfo = getstockdata(html)
+    return [dt_string, stockid, iopvinfo.get('IOPV', ''), iopvinfo.get('IOPV Chg', '')]
+
+
+async def getstockupdates(codes, tabs=Tabs, timeout=RenderTimeout):
+    # render all detail pages at once, at most 'tabs' of them in flight
+    async with TabPool(tabs, lite=True) as pool:
+        tasks = [getstockupdate(pool, code, timeout) for code in codes]
+        return await asyncio.gather(*tasks)
+
+
+def runmain(args):
+    stocks = list(args)
+    if '-L' in Options.keys():
+        stocks.extend(getstocklist(Options['-L']))
+    if not stocks:
+        stocks = ['TRCM']
+
+    tabs = int(Options.get('-n', Tabs))
+    timeout = float(Options.get('-t', RenderTimeout))
+    codes = getstockcodes(stocks)
+
+    start = time.time()
+    results = asyncio.run(getstockupdates(codes, tabs, timeout))
+    print(f"{len(codes)} pages in {time.time() - start:.1f}s", file=sys.stderr)
+
+    # write all results in one batch
     outf = sys.stdout
     if '-o' in Options.keys():
         outf = open(Options['-o'], "a")
+    outf.write(''.join('\t'.join(row) + "\n" for row in results))
+    if outf is not sys.stdout:
+        outf.close()
 
-    maxloop = 3
-    if '-t' in Options.keys():
-        maxloop = Options['-t']
-    i = 1
-    while True:
-        # show current time
-        now = datetime.now()
-        dt_string = now.strftime("%d/%m/%Y %H:%M:%S")
-        #outf.write("TIME: %s\n" % (dt_string))
-        
-        # Run JavaScript code on webpage
-        resp.html.render()
-         
-        # extract stock info
-        soup = BeautifulSoup(resp.html.html, "lxml")
-        
-        toppnl = soup.find(class_="topPnl_name")
-        tbl = soup.select("div.dataItem_hld")
-        stocktbl = [(elem.get_text(), elem.find(class_="value").get_text()) for elem in tbl]
-        #print(stocktbl)
-        
-        iopvinfo = {}
-        iopvinfo['stock name'] = toppnl.get_text()
-        iopvinfo['TIME'] = dt_string
-        for elem in stocktbl:
-            name = elem[0].split("\n")[1]
-            if name in lookup:
-                iopvinfo[name] = elem[1]
-                
-        # check loop condition
-        if (len(stocktbl[0][1]) > 0):
-            #pprint.pprint(iopvinfo)
-            outf.write('\t'.join([iopvinfo['TIME'], stockid, iopvinfo['IOPV']]))
-            outf.write("\n")
-            break
-
-        if i < maxloop:
-            i = i + 1
-            print("Data invalid. Trying again...\n")
-            time.sleep(2)
-        else:
-            print("max loop exceeded!\n")
-            outf.write('\t'.join([iopvinfo['TIME'], stockid, 'TIMEOUT']))
-            outf.write("\n")
-            break
-    outf.close()
-
-def runmain():
-    # create an HTML Session object
-    session = HTMLSession()
-     
-    # Use the object above to connect to needed webpage
-    resp = session.get("http://www.bursamarketplace.com/mkt/themarket/etf/TRCM")
-    getstockupdate(resp, 'TRCM')
-    resp.close()
 
 argv = sys.argv[1:]
 try:
-    opts, args = getopt.getopt(argv, 'ho:t:')
+    opts, args = getopt.getopt(argv, 'hL:n:o:t:')
     Options = dict(opts)
     #print(args)
     #print(Options)
-    runmain()
+    runmain(args)
 except getopt.GetoptError:
     #Print a message or do something useful
     print('Something went wrong!')
@@ -0,0 +1,207 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+import multiprocessing
+import threading
+import getopt
+import time
+import sys
+from crontab import Crontab
+
+KillGrace = 10          # seconds a timed out process gets to exit on SIGTERM
+
+
+class Job:
+    def __init__(self, name, spec, func, overlap='skip', timeout=None, process=False):
+        assert overlap in ['skip', 'queue', 'coalesce']
+        self.name = name
+        self.cron = Crontab(spec, func)
+        self.func = func
+        self.overlap = overlap      # what to do with a slot while still running
+        self.timeout = timeout      # seconds, None for no limit
+        self.process = process      # run in a new process that can be killed
+        self.next_slot = None
+        self.running = False
+        self.overdue = None         # thread still running past its timeout
+        self.pending = 0
+        self.runs = 0
+        self.skipped = 0
+        self.timeouts = 0
+        self.failures = 0
+
+
+class Scheduler:
+    def __init__(self, workers=None):
+        self.jobs = []
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.alive = False
+
+    def add(self, name, spec, func, overlap='skip', timeout=None, process=False):
+        job = Job(name, spec, func, overlap=overlap, timeout=timeout, process=process)
+        self.jobs.append(job)
+        return job
+
+    def log(self, job, msg):
+        date = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{date}] {job.name}: {msg}")
+
+    def trigger(self, job):
+        # apply the overlap policy, then hand the job to the worker pool
+        with self.lock:
+            if job.overdue is not None and not job.overdue.is_alive():
+                job.overdue = None
+            if job.overdue is not None:
+                # nothing waits on it, so no slot can be queued behind it
+                job.skipped += 1
+                self.log(job, 'overdue, slot skipped')
+                return
+            if job.running:
+                if job.overlap == 'skip':
+                    job.skipped += 1
+                    self.log(job, 'still running, slot skipped')
+                elif job.overlap == 'coalesce':
+                    job.pending = 1
+                else:
+                    job.pending += 1
+                return
+            job.running = True
+        self.pool.submit(self.execute, job)
+
+    def execute(self, job):
+        while True:
+            start = time.time()
+            try:
+                if job.process:
+                    self.run_process(job)
+                else:
+                    self.run_thread(job)
+            except Exception as err:
+                job.failures += 1
+                self.log(job, f'ERROR {err!r}')
+            job.runs += 1
+            self.log(job, f'done in {time.time() - start:.1f}s')
+
+            with self.lock:
+                if job.pending and self.alive:
+                    job.pending -= 1
+                    continue
+                job.pending = 0
+                job.running = False
+                return
+
+    def run_thread(self, job):
+        # a thread cannot be killed, a job that runs past its timeout is
+        # reported and left behind as overdue, its slots skipped until it
+        # ends, so it does not hold on to a worker
+        thread = threading.Thread(target=job.func, name=job.name, daemon=True)
+        thread.start()
+        thread.join(job.timeout)
+        if thread.is_alive():
+            job.timeouts += 1
+            job.overdue = thread
+            self.log(job, f'still running after {job.timeout}s, left overdue')
+
+    def run_process(self, job):
+        # spawned, not forked: a fork of this process copies the locks its
+        # other threads (the queue, the browser session) may hold. The job
+        # must be picklable, e.g. a module function or a partial of one.
+        ctx = multiprocessing.get_context('spawn')
+        proc = ctx.Process(target=job.func, name=job.name)
+        proc.start()
+        proc.join(job.timeout)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(KillGrace)
+            if proc.is_alive():
+                proc.kill()
+                proc.join()
+            job.timeouts += 1
+            raise TimeoutError(f'killed after {job.timeout}s')
+        if proc.exitcode:
+            raise RuntimeError(f'exit code {proc.exitcode}')
+
+    def run(self):
+        assert self.jobs
+        self.alive = True
+        self.wakeup.clear()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers or len(self.jobs))
+
+        now = datetime.now()
+        for job in self.jobs:
+            job.next_slot = job.cron.next_time(now)
+
+        try:
+            while self.alive:
+                slot = min(job.next_slot for job in self.jobs)
+                wait = (slot - datetime.now()).total_seconds()
+                if wait > 0:
+                    self.wakeup.wait(wait)
+                    continue
+
+                # missed slots of a job collapse into one run
+                now = datetime.now()
+                for job in self.jobs:
+                    if job.next_slot <= now:
+                        self.trigger(job)
+                        job.next_slot = job.cron.next_time(now)
+        finally:
+            self.pool.shutdown(wait=True)
+
+    def stop(self):
+        self.alive = False
+        self.wakeup.set()
+
+    def status(self):
+        return dict((job.name, {
+            'running': job.running,
+            'overdue': job.overdue is not None and job.overdue.is_alive(),
+            'pending': job.pending,
+            'runs': job.runs,
+            'skipped': job.skipped,
+            'timeouts': job.timeouts,
+            'failures': job.failures,
+            'next': str(job.next_slot),
+        }) for job in self.jobs)
+
+
+if __name__ == "__main__":
+    import iopvfire
+    import iopvdaily
+    import stockcharts
+    from utils import getstocklist
+
+    argv = sys.argv[1:]
+    stocklist = []
+    try:
+        opts, args = getopt.getopt(argv, 'a:L:')
+        Options = dict(opts)
+        if '-a' in Options.keys():
+            iopvfire.IopvArchiveFile = Options['-a']
+        if '-L' in Options.keys():
+            stocklist = getstocklist(Options['-L'])
+    except getopt.GetoptError:
+        print('Invalid command line option or arguments')
+        sys.exit(2)
+
+    # IOPV capture, chart build and daily rollup in one process
+    session = iopvfire.start_session()
+    queue = iopvfire.start_queue()
+    sched = Scheduler()
+    sched.add('iopv', "* 9-12,14-17 * * 1-5", iopvfire.daemon_update,
+              overlap='skip', timeout=55)
+    if stocklist:
+        sched.add('charts', "*/5 9-12,14-18 * * 1-5",
+                  partial(stockcharts.make_firebase_charts, stocklist),
+                  overlap='coalesce', timeout=240, process=True)
+        sched.add('daily', "30 17 * * 1-5",
+                  partial(iopvdaily.runmain, stocklist),
+                  overlap='queue', timeout=600, process=True)
+    try:
+        sched.run()
+    finally:
+        queue.stop()
+        if session:
+            session.close()
@@ -8,14 +8,19 @@ import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 from gspreaddb import GspreadDB
-from utils import getstocklist
-from datetime import datetime
+from utils import getstocklist, statefile
+from datetime import datetime, date, timedelta
 from fireworks import Firework
+from iopvstore import open_store
 
 DailyDbName = 'iopvdb-daily'
 JsonFile = 'iopv.json'
 OutputFile = 'etf_charts.html'
+MirrorFile = statefile('iopv-mirror.sqlite')   # local copy of the history, None to read Firebase
 firebase_config_file = 'firebase_config.json'
+StoreSpec = None        # chart from these stores instead, see open_store()
+DailyDays = 300         # calendar days of daily bars read from a store
+RawDays = 7             # calendar days of ticks read from a store
 
 
 def load_firebase_stock(db, dbase_id, stock):
@@ -186,7 +191,7 @@ def get_missing_minutes(df):
     start_date, end_date = sorted([df['DATE'].iloc[0], df['DATE'].iloc[-1]])
     sd = pd.to_datetime(start_date).strftime("%Y-%m-%d %H:%M")
     ed = pd.to_datetime(end_date).strftime("%Y-%m-%d %H:%M")
-    all_dates = pd.date_range(start=sd, end=ed, freq='5T').strftime("%Y-%m-%d %H:%M").tolist()
+    all_dates = pd.date_range(start=sd, end=ed, freq='5min').strftime("%Y-%m-%d %H:%M").tolist()
 
     # retrieve the dates that ARE in the original dataset
     in_dates = [d.strftime("%Y-%m-%d %H:%M") for d in pd.to_datetime(df['DATE'])]
@@ -209,7 +214,7 @@ def html_title(date):
 
 
 def make_stock_charts(stocklist):
-    assert slist
+    assert stocklist
 
     dailydb = GspreadDB(DailyDbName, 'DAILY', JsonFile)
     figs = []
@@ -239,62 +244,67 @@ def make_stock_charts(stocklist):
 
 
 def make_ohlc(raw_iopv):
-    ohlc_list = []
-    last_iopv = None
-    for rec in raw_iopv:
-        date = rec['DATE']
-        iopv = rec['IOPV']
-        op = last_iopv if last_iopv else iopv
-        cl = iopv
-        hi = max(cl, op)
-        lo = min(cl, op)
-        #ohlc = {'DATE': date, 'OPEN': op, 'HIGH': hi, 'LOW': lo, 'CLOSE': cl}
-        ohlc = {'DATE': date, 'OPEN': iopv, 'HIGH': iopv, 'LOW': iopv, 'CLOSE': iopv}
-        ohlc_list.append(ohlc)
-        last_iopv = iopv
-    return ohlc_list
-
-
-def precond_daily(ohlc_list):
-    new_list = []
-    for rec in ohlc_list:
-        if rec['OPEN'] == rec['HIGH'] == rec['LOW'] == rec['LOW']:
-            if new_list and new_list[-1]['CLOSE'] == rec['OPEN']:
-                continue
-        new_list.append(rec)
-    return new_list
-
-
-def precond_minutes(iopv_list):
-    new_list = []
-    last_iopv = ''
-    for rec in iopv_list:
-        iopv = rec['IOPV']
-        if iopv != last_iopv:
-            new_list.append(rec)
-        last_iopv = iopv
-    return new_list
+    # every tick as a flat bar
+    return raw_iopv.assign(OPEN=raw_iopv.IOPV, HIGH=raw_iopv.IOPV,
+                           LOW=raw_iopv.IOPV, CLOSE=raw_iopv.IOPV)
+
+
+def precond_daily(ohlc):
+    # drop flat bars that only repeat the previous close
+    flat = (ohlc.OPEN == ohlc.HIGH) & (ohlc.HIGH == ohlc.LOW)
+    return ohlc[~(flat & (ohlc.OPEN == ohlc.CLOSE.shift()))]
+
+
+def precond_minutes(iopv):
+    # drop blank or non-numeric ticks, then keep the ticks where the price changed
+    iopv = iopv.assign(IOPV=pd.to_numeric(iopv.IOPV, errors='coerce')).dropna(subset=['IOPV'])
+    return iopv[iopv.IOPV.ne(iopv.IOPV.shift())]
 
 
 def make_firebase_charts(stocklist):
-    assert slist
+    assert stocklist
 
-    fire = Firework()
+    fire = Firework(mirror_file=MirrorFile)
     stock_dict = dict([(x, fire.get_stock_ticker(x)) for x in stocklist])
-    stock_daily = fire.get_stock_daily(stock_dict.values(), last=200)
-    stock_raw = fire.get_stock_raw(stock_dict.values(), last=1200)
+    stock_daily = fire.get_stock_daily(stock_dict.values(), last=200, result='frame')
+
+    # only the charted tickers' ticks, from the whole-market snapshots
+    # for tickers not in the per-ticker layout yet
+    stock_raw = fire.get_ticker_raw(stock_dict.values(), result='frame')
+    missing = [x for x in stock_dict.values() if x not in set(stock_raw.TICKER)]
+    if missing:
+        extra = fire.get_stock_raw(missing, last=1200, result='frame')
+        stock_raw = pd.concat([stock_raw, extra], ignore_index=True)
+    write_charts(stocklist, stock_dict, stock_daily, stock_raw)
+
+
+def make_store_charts(stocklist, spec):
+    assert stocklist
+
+    # date ranges of one store, e.g. a local SQLite store
+    store = open_store(spec)
+    stock_dict = dict([(x, store.resolve_ticker(x)) for x in stocklist])
+    today = date.today()
+    stock_daily = store.read_range(stock_dict.values(), str(today - timedelta(DailyDays)),
+                                   daily=True, result='frame')
+    stock_raw = store.read_range(stock_dict.values(), str(today - timedelta(RawDays)),
+                                 result='frame')
+    write_charts(stocklist, stock_dict, stock_daily, stock_raw)
+
+
+def write_charts(stocklist, stock_dict, stock_daily, stock_raw):
     figs = []
     data_list = []
     for stock in stocklist:
         ticker = stock_dict[stock]
-        stock_daily_data = precond_daily(stock_daily[ticker])
-        df = pd.DataFrame(stock_daily_data).sort_values('DATE')
+        df = precond_daily(stock_daily[stock_daily.TICKER == ticker]).reset_index(drop=True)
+        df['DATE'] = df.DATE.dt.strftime('%Y-%m-%d')
         fig, data = make_chart(df, f'{stock} [Day]')
         figs.append(fig)
         stock_summary = data
 
-        stock_raw_data = precond_minutes(stock_raw[ticker])
-        df = pd.DataFrame(make_ohlc(stock_raw_data[-120:])).sort_values('DATE')
+        raw = precond_minutes(stock_raw[stock_raw.TICKER == ticker])
+        df = make_ohlc(raw.tail(120)).reset_index(drop=True)
         fig, data = make_minute_chart(df, f'{stock} [5-min]')
         figs.append(fig)
 
@@ -313,8 +323,8 @@ def make_firebase_charts(stocklist):
         pass
 
     with open(OutputFile, 'a') as f:
-        latest_data = stock_raw[stock_dict[stocklist[0]]][-1]
-        latest_date = latest_data['DATE']
+        latest_data = stock_raw[stock_raw.TICKER == stock_dict[stocklist[0]]]
+        latest_date = str(latest_data.DATE.iloc[-1])
         f.write(html_title(latest_date))
         table = plot_table(data_list)
         f.write(table)
@@ -628,7 +638,7 @@ if __name__ == "__main__":
     UseFirebase = False
     try:
         # parse command line options
-        opts, args = getopt.getopt(argv, 'fL:s:o:')
+        opts, args = getopt.getopt(argv, 'fL:m:s:o:S:')
         Options = dict(opts)
 
         if '-L' in Options.keys():
@@ -639,6 +649,10 @@ if __name__ == "__main__":
             OutputFile = Options['-o']
         if '-f' in Options.keys():
             UseFirebase = True
+        if '-m' in Options.keys():
+            MirrorFile = Options['-m'] or None
+        if '-S' in Options.keys():
+            StoreSpec = Options['-S']
     except getopt.GetoptError:
         print('Invalid command line option or arguments')
         sys.exit(2)
@@ -647,7 +661,9 @@ if __name__ == "__main__":
         make_csv_chart(CSVfile)
     elif StockListFile:
         slist = getstocklist(StockListFile)
-        if UseFirebase:
+        if StoreSpec:
+            make_store_charts(slist, StoreSpec)
+        elif UseFirebase:
             make_firebase_charts(slist)
         else:
             make_stock_charts(slist)
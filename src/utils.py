@@ -1,4 +1,28 @@
+import os
 import re
+import json
+import tempfile
+
+# local state files live here whatever directory a script is run from
+StateDir = os.environ.get('IOPV_STATE_DIR') or os.path.dirname(os.path.abspath(__file__))
+
+
+def statefile(name):
+    return os.path.join(StateDir, name)
+
+
+def save_json(filename, data):
+    # write to a temporary file of this process, then rename it over
+    # filename, so readers and other writers never see a partial file
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                    prefix=os.path.basename(filename), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, filename)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
 
 
 def getstocklist(filename):
@@ -13,3 +37,30 @@ def isvalid(x):
         re.search(r"^\s*$", x)
     )
     return not skip
+
+
+def process_rss(pid):
+    # resident memory (bytes) of a process and all of its children (Linux)
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        pending.extend(children.get(p, []))
+        try:
+            with open(f'/proc/{p}/statm') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except OSError:
+            pass
+    return total
@@ -0,0 +1,204 @@
+import pyppeteer
+from pyppeteer.errors import TimeoutError as PageTimeoutError
+from utils import process_rss
+from urllib.parse import urlparse
+import asyncio
+import time
+
+MaxRenders = 300        # recycle the browser after this many page loads
+MaxMemory = 500         # recycle the browser when Chromium grows beyond this (MB)
+RenderTimeout = 20      # overall deadline (seconds) for a page load and its data
+PollInterval = 0.02     # seconds between DOM readiness checks
+
+# allow-list of a lite render, any other request is aborted
+AllowTypes = ['document', 'script', 'xhr', 'fetch']
+AllowHosts = ['bursamarketplace.com']
+Tabs = 8                # browser tabs open at once in a TabPool
+
+# signal handlers can only be installed from the main thread
+LaunchOptions = {'headless': True, 'args': ['--no-sandbox'], 'handleSIGINT': False,
+                 'handleSIGTERM': False, 'handleSIGHUP': False}
+
+
+class RequestFilter:
+    def __init__(self, allow_types=None, allow_hosts=None):
+        self.allow_types = AllowTypes if allow_types is None else allow_types
+        self.allow_hosts = AllowHosts if allow_hosts is None else allow_hosts
+        self.blocked = 0
+
+    def allowed(self, request):
+        if request.resourceType not in self.allow_types:
+            return False
+        host = urlparse(request.url).hostname or ''
+        return any(host == h or host.endswith('.' + h) for h in self.allow_hosts)
+
+    async def filter(self, request):
+        if self.allowed(request):
+            await request.continue_()
+        else:
+            self.blocked += 1
+            await request.abort()
+
+    async def attach(self, page):
+        await page.setRequestInterception(True)
+        page.on('request', lambda req: asyncio.ensure_future(self.filter(req)))
+
+
+class WebSession:
+    def __init__(self, url, max_renders=MaxRenders, max_memory=MaxMemory,
+                 lite=False, allow_types=None, allow_hosts=None):
+        self.url = url
+        self.max_renders = max_renders
+        self.max_memory = max_memory
+        self.filter = RequestFilter(allow_types, allow_hosts) if lite else None
+        self.loop = None
+        self.browser = None
+        self.page = None
+        self.renders = 0
+        self.ready_time = None
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def open(self, timeout=RenderTimeout):
+        # launch headless Chromium once and keep a single page on the url,
+        # on an event loop of our own so any thread can drive the session
+        self.loop = asyncio.new_event_loop()
+        self.browser = self.run(pyppeteer.launch(**LaunchOptions))
+        self.page = self.run(self.browser.newPage())
+        if self.filter:
+            self.run(self.filter.attach(self.page))
+        self.goto(timeout)
+
+    @property
+    def blocked(self):
+        return self.filter.blocked if self.filter else 0
+
+    def goto(self, timeout):
+        # only wait for the DOM, the data is polled for separately
+        options = {'timeout': timeout * 1000, 'waitUntil': 'domcontentloaded'}
+        if self.renders:
+            self.run(self.page.reload(options))
+        else:
+            self.run(self.page.goto(self.url, options))
+        self.renders += 1
+
+    def wait_for(self, script, timeout):
+        options = {'polling': PollInterval * 1000, 'timeout': timeout * 1000}
+        self.run(self.page.waitForFunction(script, options))
+
+    def close(self):
+        # also after a crash, when Chromium or its connection is gone
+        if self.browser:
+            try:
+                self.run(self.browser.close())
+            except Exception as err:
+                print(f'browser close failed: {err!r}')
+                proc = self.browser.process
+                if proc and proc.poll() is None:
+                    proc.kill()
+        if self.loop:
+            self.loop.close()
+        self.loop = None
+        self.browser = None
+        self.page = None
+        self.renders = 0
+
+    def memory(self):
+        # resident memory of Chromium and its child processes in MB
+        if not self.browser:
+            return 0
+        proc = self.browser.process
+        if not proc:
+            return 0
+        return process_rss(proc.pid) / (1024 * 1024)
+
+    def expired(self):
+        proc = self.browser.process if self.browser else None
+        if proc and proc.poll() is not None:
+            return True
+        if self.max_renders and self.renders >= self.max_renders:
+            return True
+        if self.max_memory and self.memory() > self.max_memory:
+            return True
+        return False
+
+    def render(self, ready=None, timeout=RenderTimeout):
+        # load the page, then poll the DOM until the 'ready' script returns
+        # true, all within a single deadline
+        if self.page and self.expired():
+            print(f'recycling browser after {self.renders} renders '
+                  f'({self.memory():.0f} MB)')
+            self.close()
+
+        start = time.time()
+        self.ready_time = None
+        try:
+            if not self.page:
+                self.open(timeout)
+            else:
+                self.goto(timeout)
+
+            if ready:
+                remain = max(timeout - (time.time() - start), PollInterval)
+                self.wait_for(ready, remain)
+        except PageTimeoutError:
+            # the page may be stuck mid-load, start the next render afresh
+            self.close()
+            raise TimeoutError(f'page data not ready after {timeout}s')
+        except Exception:
+            # a dead Chromium or a dropped connection, relaunch next time
+            self.close()
+            raise
+
+        self.ready_time = time.time() - start
+        return self.run(self.page.content())
+
+
+class TabPool:
+    # a bounded set of tabs in one browser, shared by concurrent page loads
+    def __init__(self, size=Tabs, lite=False, allow_types=None, allow_hosts=None):
+        self.size = size
+        self.filter = RequestFilter(allow_types, allow_hosts) if lite else None
+        self.browser = None
+        self.tabs = None
+
+    async def open(self):
+        self.browser = await pyppeteer.launch(**LaunchOptions)
+        self.tabs = asyncio.Queue()
+        for i in range(self.size):
+            page = await self.browser.newPage()
+            if self.filter:
+                await self.filter.attach(page)
+            self.tabs.put_nowait(page)
+
+    async def close(self):
+        if self.browser:
+            await self.browser.close()
+        self.browser = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def render(self, url, ready=None, timeout=RenderTimeout):
+        # wait for a free tab, then load url and poll for its data
+        page = await self.tabs.get()
+        start = time.time()
+        try:
+            options = {'timeout': timeout * 1000, 'waitUntil': 'domcontentloaded'}
+            await page.goto(url, options)
+            if ready:
+                remain = max(timeout - (time.time() - start), PollInterval)
+                options = {'polling': PollInterval * 1000, 'timeout': remain * 1000}
+                await page.waitForFunction(ready, options)
+            html = await page.content()
+        except PageTimeoutError:
+            raise TimeoutError(f'{url} data not ready after {timeout}s')
+        finally:
+            self.tabs.put_nowait(page)
+
+        return html, time.time() - start
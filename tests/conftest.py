@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from fireemu import FireEmulator    # noqa: E402
+from fireworks import Firework      # noqa: E402
+
+
+@pytest.fixture
+def emulator():
+    with FireEmulator() as emulator:
+        yield emulator
+
+
+@pytest.fixture
+def fire(emulator, tmp_path, monkeypatch):
+    # a Firework on the emulator, its local state files in tmp_path
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr('fireworks.ohlc_state_file', str(tmp_path / 'iopv-ohlc.json'))
+    monkeypatch.setattr('fireworks.stock_cache_file', str(tmp_path / 'stock-list-cache.json'))
+    config_file = str(tmp_path / 'emulator_config.json')
+    emulator.write_config(config_file)
+    return Firework(config_file)
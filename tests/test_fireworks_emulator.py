@@ -0,0 +1,175 @@
+import datetime
+
+import pytest
+import requests
+
+from fireworks import Firework, StockListCache, transaction, raw_db, shard_db
+
+
+def snapshots(times):
+    return dict((ts, {'DATE': ts, 'IOPV': {'A': i, 'B': i * 10}}) for i, ts in enumerate(times))
+
+
+Times = [f'2024-01-02 09:0{i}:00' for i in range(5)]
+
+
+def test_key_queries(fire, emulator):
+    emulator.set([raw_db], snapshots(Times))
+    db = fire.firebase.database()
+    rows = db.child(raw_db).order_by_key().start_at(Times[1]).end_at(Times[3]).get().val()
+    assert list(rows) == Times[1:4]
+    rows = db.child(raw_db).order_by_key().limit_to_last(2).get().val()
+    assert list(rows) == Times[3:]
+    assert sorted(db.child(raw_db).shallow().get().val()) == Times
+
+
+def test_child_queries(fire, emulator):
+    emulator.set([raw_db], snapshots(Times))
+    rows = fire.get_stock_raw(['A'], last=2)
+    assert rows == {'A': [{'DATE': Times[3], 'IOPV': 3}, {'DATE': Times[4], 'IOPV': 4}]}
+
+
+def test_iter_range_pages(fire, emulator):
+    emulator.set([raw_db], snapshots(Times))
+    pages = list(fire.iter_range(raw_db, Times[1], Times[4][:15], page=2))
+    assert [list(x) for x in pages] == [Times[1:3], Times[3:5]]
+
+
+def test_ticker_layout(fire, emulator):
+    emulator.set([shard_db], {'A': {'2024-01-01': {'09:00:00': 1.0},
+                                    '2024-01-02': {'09:00:00': 1.1, '09:01:00': 1.2}}})
+    rows = fire.ticker_rows('A', False, start='2024-01-02')
+    assert rows == [{'DATE': '2024-01-02 09:00:00', 'IOPV': 1.1},
+                    {'DATE': '2024-01-02 09:01:00', 'IOPV': 1.2}]
+
+
+def test_transaction_retries_on_etag_mismatch(fire, emulator):
+    emulator.set(['counter'], {'N': 1})
+    seen = []
+
+    def bump(value):
+        seen.append(value)
+        if len(seen) == 1:
+            emulator.set(['counter'], {'N': 10})     # another writer gets in first
+        return {'N': value['N'] + 1}
+
+    assert transaction(fire.firebase.database(), 'counter', bump) == {'N': 11}
+    assert seen == [{'N': 1}, {'N': 10}]
+    assert emulator.get(['counter']) == {'N': 11}
+
+
+def test_new_stocks_share_tickers(fire, emulator):
+    assert fire.resolve_ticker('A Fund') == 'NEWETF-1'
+    assert fire.resolve_ticker('B Fund') == 'NEWETF-2'
+    other = Firework(fire.config_file)
+    other.stocks = StockListCache(other.firebase, cache_file=None)
+    assert other.resolve_ticker('B Fund') == 'NEWETF-2'
+    assert other.resolve_ticker('C Fund') == 'NEWETF-3'
+
+
+def test_batch_multi_path_patch(fire, emulator):
+    emulator.set(['c'], 5)
+    batch = fire.batch(chunk_size=2)
+    batch.set('a/x', 1)
+    batch.set('a/y/z', 2)
+    batch.set('b', {'k': 1})
+    batch.set('b/j', 2)         # merged into the pending value of b
+    batch.remove('c')
+    assert batch.commit() == 4
+    assert batch.requests == 2
+    assert emulator.get(['a']) == {'x': 1, 'y': {'z': 2}}
+    assert emulator.get(['b']) == {'k': 1, 'j': 2}
+    assert emulator.get(['c']) is None
+
+
+def test_patch_rejects_ancestor_paths(fire):
+    with pytest.raises(requests.HTTPError):
+        fire.firebase.database().update({'a': 1, 'a/b': 2})
+
+
+def test_update_iopv_list(fire, emulator):
+    start = datetime.datetime(2024, 1, 2, 9, 0)
+    for i, iopv in enumerate([1.0, 1.2, 1.1]):
+        fire.update_iopv_list([('A Fund', iopv)], logtime=start + datetime.timedelta(minutes=i))
+    ticker = fire.resolve_ticker('A Fund')
+    raw = fire.get_stock_raw([ticker], last=10)
+    assert [x['IOPV'] for x in raw[ticker]] == [1.0, 1.2, 1.1]
+    daily = fire.get_stock_daily([ticker], last=1)
+    assert daily[ticker] == [{'DATE': '2024-01-02', 'OPEN': 1.2, 'HIGH': 1.2, 'LOW': 1.1, 'CLOSE': 1.1}]
+
+
+def test_hand_added_stock_is_not_reallocated(fire, emulator):
+    assert fire.resolve_ticker('A Fund') == 'NEWETF-1'
+    emulator.set(['stock-list', 'XYZ'], {'STOCK': 'B Fund', 'TICKER': 'XYZ'})
+    assert fire.resolve_ticker('B Fund') == 'XYZ'
+    assert fire.get_stock_name('XYZ') == 'B Fund'
+
+
+def test_purge_raw_covers_unlisted_tickers(fire, emulator, monkeypatch):
+    monkeypatch.setattr('fireworks.raw_layouts', ('ticker',))
+    old, new = str(datetime.date.today() - datetime.timedelta(30)), str(datetime.date.today())
+    emulator.set([shard_db], {'GONE': {old: {'09:00:00': 1.0}},
+                              'A': {old: {'09:00:00': 1.0}, new: {'09:00:00': 1.1}}})
+    fire.purge_raw(keep_days=7, save_to='purged.jsonl.gz')
+    assert emulator.get([shard_db]) == {'A': {new: {'09:00:00': 1.1}}}
+
+
+@pytest.mark.parametrize('layouts', [('ticker',), ('packed',)])
+def test_cold_start_replays_the_day(fire, emulator, monkeypatch, layouts):
+    monkeypatch.setattr('fireworks.raw_layouts', layouts)
+    start = datetime.datetime(2024, 1, 2, 9, 0)
+    for i, iopv in enumerate([1.0, 1.2, 1.1]):
+        fire.update_iopv_list([('A Fund', iopv)], logtime=start + datetime.timedelta(minutes=i))
+    ticker = fire.resolve_ticker('A Fund')
+
+    # a new process without the local OHLC state or stock list
+    monkeypatch.setattr('fireworks.ohlc_state_file', None)
+    other = Firework(fire.config_file)
+    other.stocks = StockListCache(other.firebase, cache_file=None)
+    other.update_iopv_list([('A Fund', 1.3)], logtime=start + datetime.timedelta(minutes=3))
+    assert emulator.get(['iopv-daily', '2024-01-02', 'IOPV', ticker]) == \
+        {'OPEN': 1.2, 'HIGH': 1.3, 'LOW': 1.1, 'CLOSE': 1.3}
+
+
+def test_batch_leaves_callers_values_alone(fire, emulator):
+    bars = {'A': {'CLOSE': 1.0}}
+    batch = fire.batch()
+    batch.set('iopv-daily/2024-01-02/IOPV', bars)
+    batch.set('iopv-daily/2024-01-02/IOPV/B', {'CLOSE': 2.0})
+    assert bars == {'A': {'CLOSE': 1.0}}
+    batch.commit()
+    assert emulator.get(['iopv-daily', '2024-01-02', 'IOPV']) == {'A': {'CLOSE': 1.0}, 'B': {'CLOSE': 2.0}}
+
+
+def test_mirror_picks_up_late_ticks(fire, emulator, tmp_path):
+    from firemirror import FireMirror
+    emulator.set([raw_db], snapshots([Times[0], Times[2]]))
+    mirror = FireMirror(fire, str(tmp_path / 'mirror.sqlite'))
+    assert mirror.sync(raw_db, force=True) == 2
+    # a tick flushed late from the write-behind queue, older than the last key
+    emulator.set([raw_db, Times[1]], {'DATE': Times[1], 'IOPV': {'A': 9}})
+    mirror.sync(raw_db, force=True)
+    rows = mirror.read_range(['A'], Times[0], Times[2])
+    assert [x['IOPV'] for x in rows['A']] == [0, 9, 1]
+
+
+def test_non_numeric_iopv_has_no_bar(fire, emulator):
+    start = datetime.datetime(2024, 1, 2, 9, 0)
+    for i in range(2):
+        fire.update_iopv_list([('A Fund', 1.0 + i), ('B Fund', '-')],
+                              logtime=start + datetime.timedelta(minutes=i))
+    daily = emulator.get(['iopv-daily', '2024-01-02', 'IOPV'])
+    assert list(daily) == [fire.resolve_ticker('A Fund')]
+
+
+def test_import_keeps_data_on_bad_file(fire, emulator, tmp_path):
+    emulator.set(['imported'], {'a': 1})
+    bad = tmp_path / 'bad.json'
+    bad.write_text('{"b": 2, "c": ')
+    with pytest.raises(ValueError):
+        fire.import_json('imported', str(bad))
+    assert emulator.get(['imported']) == {'a': 1}
+    good = tmp_path / 'good.json'
+    good.write_text('{"b": 2, "c": 3}')
+    assert fire.import_json('imported', str(good)) == 2
+    assert emulator.get(['imported']) == {'b': 2, 'c': 3}